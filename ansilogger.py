@@ -10,7 +10,9 @@ class AnsiLogger(Thread):
         "error": "\033[91m",
         "processing": "\033[31m",
         "processed": "\033[33m",
-        "finished": "\033[32m"
+        "finished": "\033[32m",
+        "progress": "\033[36m",
+        "metrics": "\033[35m"
     }
 
     def __init__(self, parent_connection, use_ansi=True):
@@ -25,30 +27,50 @@ class AnsiLogger(Thread):
         else:
             self.log = self.non_ansi_log
 
-    def ansi_log(self, name, status):
-        line = f"[{AnsiLogger.status_color[status]}{status:>10}{AnsiLogger.NORMAL}] {name}"
+    def ansi_log(self, name, status, text=None):
+        line = f"[{AnsiLogger.status_color[status]}{status:>10}{AnsiLogger.NORMAL}] {text or name}"
         if name in self.question_rows:
             print("\0337", end="")
             self.up(self.current_row - self.question_rows[name])
-            print(f"{line}\0338", end="", flush=True)
+            print(f"{line}\033[K\0338", end="", flush=True)
         else:
             self.question_rows[name] = self.current_row
             self.current_row += 1
             print(line, flush=True)
 
+    @staticmethod
+    def format_progress(counters):
+        line = f"{counters['stage']}: {counters['done']}/{counters['total']}"
+        if counters['errors']:
+            line += f", {counters['errors']} errors"
+        line += f", {counters['rate']:.1f}/s"
+        if counters['eta'] is not None and counters['done'] < counters['total']:
+            line += f", {counters['eta']:.0f}s left"
+        return line
+
+    @staticmethod
+    def format_metrics(report):
+        stages = ", ".join(f"{stage} {values['seconds']:.1f}s" for stage, values in report['stages'].items())
+        return f"{report['seconds']:.1f}s ({stages}), peak memory {report['peak_rss_mb']:.0f} MB, " \
+               f"workers {report['peak_worker_rss_mb']:.0f} MB"
+
     def run(self):
         try:
             while True:
                 status, name = self.parent_connection.recv()
                 if status == "completed":
                     break
-                else:
+                elif status == "progress":
+                    self.log((status, name['stage']), status, self.format_progress(name))
+                elif status == "metrics":
+                    self.log(status, status, self.format_metrics(name))
+                elif status is not None:
                     self.log(name, status)
         except EOFError:
             pass
 
-    def non_ansi_log(self, name, status):
-        print(f"[{status}] {name}")
+    def non_ansi_log(self, name, status, text=None):
+        print(f"[{status}] {text or name}")
 
     @staticmethod
     def up(lines):
@@ -0,0 +1,275 @@
+import argparse
+import hashlib
+import os
+import sqlite3
+import zlib
+from functools import partial
+from multiprocessing import Pipe, Pool
+
+import blackboard
+import plagiarism
+from ansilogger import AnsiLogger
+from pairreport import write_pairs
+from progress import ProgressReporter
+from similarity import metrics
+from textcache import DEFAULT_DIRECTORY, TextCache
+from winnowing import fingerprints
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS documents (
+        id INTEGER PRIMARY KEY,
+        label TEXT NOT NULL,
+        name TEXT NOT NULL,
+        digest TEXT NOT NULL UNIQUE,
+        text BLOB NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS fingerprints (
+        hash INTEGER NOT NULL,
+        document_id INTEGER NOT NULL REFERENCES documents (id),
+        PRIMARY KEY (hash, document_id)
+    ) WITHOUT ROWID;
+"""
+
+
+class Archive:
+    """A persistent archive of submissions of previous years, indexed by winnowing fingerprints.
+
+    The archive is an SQLite database with the compressed text of every document
+    and an inverted index from fingerprint to documents. A new submission is
+    looked up by probing the index with its fingerprints. Only the archived
+    documents that share the most fingerprints with it are compared exactly.
+    """
+
+    def __init__(self, filename):
+        self.connection = sqlite3.connect(filename)
+        self.connection.executescript(SCHEMA)
+
+    def add(self, label, name, text, hashes):
+        """Add a document unless a document with the same text is already archived.
+
+        :return True if the document was added
+        """
+        digest = hashlib.sha256(text.encode()).hexdigest()
+        with self.connection:
+            cursor = self.connection.execute(
+                "INSERT OR IGNORE INTO documents (label, name, digest, text) VALUES (?, ?, ?, ?)",
+                (label, name, digest, zlib.compress(text.encode()))
+            )
+            if cursor.rowcount == 0:
+                return False
+            self.connection.executemany(
+                "INSERT INTO fingerprints (hash, document_id) VALUES (?, ?)",
+                ((value, cursor.lastrowid) for value in hashes)
+            )
+        return True
+
+    def probe(self, hashes, limit):
+        """Return the ids of the archived documents that share the most fingerprints, with their counts."""
+        self.connection.execute("CREATE TEMPORARY TABLE IF NOT EXISTS probe (hash INTEGER PRIMARY KEY)")
+        self.connection.execute("DELETE FROM probe")
+        self.connection.executemany("INSERT INTO probe (hash) VALUES (?)", ((value,) for value in hashes))
+        return self.connection.execute(
+            """
+            SELECT document_id, COUNT(*) AS shared FROM probe JOIN fingerprints USING (hash)
+            GROUP BY document_id ORDER BY shared DESC LIMIT ?
+            """,
+            (limit,)
+        ).fetchall()
+
+    def document(self, document_id):
+        label, name, text = self.connection.execute(
+            "SELECT label, name, text FROM documents WHERE id = ?", (document_id,)
+        ).fetchone()
+        return label, name, zlib.decompress(text).decode()
+
+    def query(self, text, candidates=20, top=5):
+        """Find the archived documents most similar to text.
+
+        :param text The text of the new submission
+        :param candidates The number of index hits that are compared exactly
+        :param top The number of results
+        :return A list of (label, name, shared fingerprints, similarity) tuples, most similar first
+        """
+        results = []
+        for document_id, shared in self.probe(text_fingerprints(text), candidates):
+            label, name, archived_text = self.document(document_id)
+            results.append((label, name, shared, metrics['difflib'].ratio(text, archived_text)))
+        results.sort(key=lambda result: result[3], reverse=True)
+        return results[:top]
+
+    def close(self):
+        self.connection.close()
+
+
+def text_fingerprints(text):
+    return {value for value, _, _ in fingerprints(text)}
+
+
+def stored_documents(files, keys, cache_directory):
+    cache = TextCache(cache_directory)
+    for filename, key in zip(files, keys):
+        if key is not None:
+            yield filename, cache.get(key)
+
+
+def long_answers(input_file, min_length):
+    for ids, answers, name in plagiarism.source_factory(input_file).jobs():
+        for student_id, answer in zip(ids, answers):
+            if isinstance(answer, str) and len(answer) >= min_length:
+                yield f"{name} {student_id}", answer
+
+
+def documents(input_file, cache_directory, min_length, client_connection):
+    """Return a generator of the name and text of every submission of a Blackboard export or long answer of a
+    Surpass/TestVision export.
+
+    The submissions of a Blackboard export are converted before this returns, so
+    the conversion pool has finished before the caller starts its own pool.
+
+    :param input_file A Blackboard zip file or directory, or a Surpass or TestVision export
+    :param cache_directory The directory of the cache with text extracted from submissions
+    :param min_length Answers of Surpass and TestVision exports shorter than this are skipped
+    :param client_connection The connection progress messages are sent to
+    """
+    if blackboard.is_zip_export(input_file) or os.path.isdir(input_file) and not plagiarism.is_answer_table(input_file):
+        with blackboard.open_export(input_file) as export:
+            _, files = blackboard.split_metafiles(export.names())
+        keys = blackboard.convert_all(input_file, files, cache_directory, client_connection)
+        return stored_documents(files, keys, cache_directory)
+    else:
+        return long_answers(input_file, min_length)
+
+
+def fingerprint_document(document):
+    name, text = document
+    return name, text, text_fingerprints(text)
+
+
+# The archive opened by open_archive in every query worker
+archive = None
+
+
+def open_archive(filename):
+    global archive
+    archive = Archive(filename)
+
+
+def query_document(document, candidates=20, top=5):
+    name, text = document
+    return name, archive.query(text, candidates, top)
+
+
+def add_to_archive(archive_file, input_file, label, cache_directory, min_length, client_connection):
+    target = Archive(archive_file)
+    added = 0
+    texts = documents(input_file, cache_directory, min_length, client_connection)
+    with Pool() as pool:
+        for name, text, hashes in pool.imap(fingerprint_document, texts):
+            added += target.add(label, name, text, hashes)
+    target.close()
+    client_connection.send(("finished", f"added {added} documents to {archive_file}"))
+
+
+def query_archive(archive_file, input_file, output_file, cache_directory, min_length, candidates, top,
+                  client_connection):
+    header = ["document", "archived document", "label", "shared fingerprints", "similarity"]
+    rows = []
+    batch = list(documents(input_file, cache_directory, min_length, client_connection))
+    progress = ProgressReporter(client_connection, "queries", len(batch))
+    with Pool(initializer=open_archive, initargs=(archive_file,)) as pool:
+        for name, results in pool.imap_unordered(partial(query_document, candidates=candidates, top=top), batch):
+            rows.extend([name, archived_name, label, shared, similarity]
+                        for label, archived_name, shared, similarity in results)
+            progress.advance()
+    rows.sort(key=lambda row: row[4], reverse=True)
+    write_pairs(output_file, header, rows, ["similarity"])
+
+
+def get_argument_parser():
+    argument_parser = argparse.ArgumentParser(description="""
+        Archive of submissions of previous years.
+
+        The add command stores the converted submissions of a Blackboard export,
+        or the long answers of a Surpass or TestVision export, in the archive.
+        The query command looks up every submission of a new export in the
+        archive and writes the most similar archived documents to a CSV, JSON
+        lines or Parquet file.
+    """)
+    argument_parser.add_argument("--archive",
+                                 default="archive.db",
+                                 help="Name of the archive database (defaults to archive.db)",
+                                 metavar="archive.db"
+                                 )
+    argument_parser.add_argument("--cache-dir",
+                                 default=DEFAULT_DIRECTORY,
+                                 dest="cache_directory",
+                                 help=f"Directory in which text extracted from submissions is cached "
+                                      f"(defaults to {DEFAULT_DIRECTORY})",
+                                 metavar="directory"
+                                 )
+    argument_parser.add_argument("--min-length",
+                                 type=int,
+                                 default=100,
+                                 help="Skip answers of Surpass and TestVision exports shorter than this number of "
+                                      "characters (defaults to 100)",
+                                 metavar="100"
+                                 )
+    argument_parser.add_argument("--no-ansi",
+                                 action="store_const",
+                                 const=False,
+                                 default=True,
+                                 dest="use_ansi",
+                                 help="Using this option will prevent ansi colors and line movements"
+                                 )
+    subparsers = argument_parser.add_subparsers(dest="command", required=True)
+    add_parser = subparsers.add_parser("add", help="Add an export to the archive")
+    add_parser.add_argument("--input",
+                            required=True,
+                            help="Blackboard zip file or directory, or Surpass or TestVision export",
+                            metavar="assignment.zip"
+                            )
+    add_parser.add_argument("--label",
+                            required=True,
+                            help="Label of the archived documents, like the course and year",
+                            metavar="2024"
+                            )
+    query_parser = subparsers.add_parser("query", help="Query the archive with a new export")
+    query_parser.add_argument("--input",
+                              required=True,
+                              help="Blackboard zip file or directory, or Surpass or TestVision export",
+                              metavar="assignment.zip"
+                              )
+    query_parser.add_argument("--output",
+                              default="archive.csv",
+                              help="Name of the generated CSV, JSON lines or Parquet file (defaults to archive.csv)",
+                              metavar="archive.csv"
+                              )
+    query_parser.add_argument("--candidates",
+                              type=int,
+                              default=20,
+                              help="Number of index hits per submission that are compared exactly (defaults to 20)",
+                              metavar="20"
+                              )
+    query_parser.add_argument("--top",
+                              type=int,
+                              default=5,
+                              help="Number of archived documents reported per submission (defaults to 5)",
+                              metavar="5"
+                              )
+    return argument_parser
+
+
+if __name__ == "__main__":
+    argument_parser = get_argument_parser()
+    arguments = argument_parser.parse_args()
+    parent_connection, client_connection = Pipe()
+    AnsiLogger(parent_connection, arguments.use_ansi).start()
+    try:
+        if arguments.command == "add":
+            add_to_archive(arguments.archive, arguments.input, arguments.label, arguments.cache_directory,
+                           arguments.min_length, client_connection)
+        else:
+            query_archive(arguments.archive, arguments.input, arguments.output, arguments.cache_directory,
+                          arguments.min_length, arguments.candidates, arguments.top, client_connection)
+    finally:
+        client_connection.send(("completed", None))
@@ -0,0 +1,10 @@
+"""Benchmarks of the plagiarism detection on synthetic Surpass, TestVision and Blackboard exports.
+
+Run them from the root of the repository:
+
+python3 -m benchmark.run --students 50 100 200 400 --output benchmark.csv
+
+or generate a single export to try the tools on:
+
+python3 -m benchmark.generate testvision --students 500 --questions 40 --output resultaten.csv
+"""
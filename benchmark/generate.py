@@ -0,0 +1,184 @@
+import argparse
+import csv
+import random
+import zipfile
+
+import pandas
+
+SYLLABLES = ["ba", "de", "ri", "ko", "lu", "ma", "ne", "pi", "so", "tu", "va", "ge", "ho", "jan", "ler", "mon",
+             "sta", "tie", "ver", "wer", "zon", "pro", "gram", "ma", "data", "ob", "ject", "func", "tie", "klas"]
+QUESTION_TYPES = ["Open", "Invul", "MeerKeuze", "MeervoudigInvul"]
+TESTVISION_FIELDS = ["KandidaatId", "KandidaatExternId", "KandidaatWeergavenaam", "OngeldigePogingen", "VraagNaam",
+                     "VraagVorm", "Antwoord", "KeuzeAntwoord"]
+
+
+class Generator:
+    """Generates reproducible answers of students of which some are near-duplicates of others.
+
+    A fraction duplicate_rate of the students copies the answer of another
+    student and changes about one word in ten, like students that plagiarise
+    and try to hide it.
+
+    :param seed The seed of the random generator, so the same arguments give the same export
+    :param answer_length The average number of words of an open answer
+    :param duplicate_rate The fraction of answers that is a near-duplicate of another answer
+    """
+
+    def __init__(self, seed=1, answer_length=50, duplicate_rate=0.05):
+        self.random = random.Random(seed)
+        self.answer_length = answer_length
+        self.duplicate_rate = duplicate_rate
+        self.vocabulary = [self.word() for _ in range(2000)]
+
+    def word(self):
+        return "".join(self.random.choice(SYLLABLES) for _ in range(self.random.randint(1, 4)))
+
+    def text(self, length=None):
+        length = length or max(1, int(self.random.gauss(self.answer_length, self.answer_length / 4)))
+        return " ".join(self.random.choice(self.vocabulary) for _ in range(length))
+
+    def near_duplicate(self, text):
+        words = text.split()
+        for _ in range(max(1, len(words) // 10)):
+            words[self.random.randrange(len(words))] = self.random.choice(self.vocabulary)
+        return " ".join(words)
+
+    def answers(self, count, length=None):
+        """Return count answers of which about duplicate_rate are near-duplicates of an earlier answer."""
+        answers = []
+        for i in range(count):
+            if i and self.random.random() < self.duplicate_rate:
+                answers.append(self.near_duplicate(self.random.choice(answers)))
+            else:
+                answers.append(self.text(length))
+        return answers
+
+    def name(self):
+        return self.word().capitalize(), self.word().capitalize()
+
+
+def surpass_export(filename, students=100, questions=10, answer_length=50, duplicate_rate=0.05, seed=1):
+    """Write an ItemsDeliveredRawReport.csv like Surpass exports it."""
+    generator = Generator(seed, answer_length, duplicate_rate)
+    answers = [generator.answers(students) for _ in range(questions)]
+    fieldnames = ["Referentie", "Voornaam", "Achternaam", "Cijfer"] + \
+                 [field for question in range(questions) for field in (f"Naam {question}", f"Reactie {question}")]
+    with open(filename, "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(fieldnames)
+        for student in range(students):
+            first_name, last_name = generator.name()
+            grade = "Ongeldig" if generator.random.random() < 0.01 else str(generator.random.randint(1, 10))
+            row = [100000 + student, first_name, last_name, grade]
+            for question in range(questions):
+                row += [f"Vraag {question + 1}", answers[question][student]]
+            writer.writerow(row)
+
+
+def testvision_rows(generator, students, questions):
+    names = [generator.name() for _ in range(students)]
+    for question in range(questions):
+        question_type = QUESTION_TYPES[question % len(QUESTION_TYPES)]
+        if question_type == "MeerKeuze":
+            answers = [[generator.random.choice("ABCD")] for _ in range(students)]
+        elif question_type == "MeervoudigInvul":
+            blanks = [generator.answers(students, 3) for _ in range(3)]
+            answers = [[blank[student] for blank in blanks] for student in range(students)]
+        else:
+            answers = [[answer] for answer in generator.answers(students)]
+        for student in range(students):
+            for answer in answers[student]:
+                yield [student, f"S{100000 + student}", " ".join(names[student]), 0, f"Vraag {question + 1}",
+                       question_type, "" if question_type == "MeerKeuze" else answer,
+                       answer if question_type == "MeerKeuze" else ""]
+
+
+def testvision_export(filename, students=100, questions=10, answer_length=50, duplicate_rate=0.05, seed=1):
+    """Write a learning analytics export of TestVision, as a CSV with trailing semicolons or as an XLSX."""
+    generator = Generator(seed, answer_length, duplicate_rate)
+    rows = testvision_rows(generator, students, questions)
+    if filename.endswith(".xlsx"):
+        pandas.DataFrame(rows, columns=TESTVISION_FIELDS).to_excel(filename, sheet_name="Data", index=False,
+                                                                   engine="openpyxl")
+    else:
+        # Like the real exports, data lines end with a semicolon that the header does not have
+        with open(filename, "w", encoding="latin-1", newline="") as file:
+            file.write(";".join(f'"{field}"' for field in TESTVISION_FIELDS) + "\n")
+            for row in rows:
+                file.write(";".join(f'"{value}"' for value in row) + ";\n")
+
+
+def blackboard_export(filename, students=100, answer_length=1000, duplicate_rate=0.05, seed=1):
+    """Write a Blackboard assignment zip with a text submission and a metafile per student."""
+    generator = Generator(seed, answer_length, duplicate_rate)
+    with zipfile.ZipFile(filename, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        for student, text in enumerate(generator.answers(students)):
+            first_name, last_name = generator.name()
+            student_number = 100000 + student
+            prefix = f"Opdracht_{student_number}_attempt_2024-01-15-10-00-00"
+            zip_file.writestr(f"{prefix}.txt", f"Name: {first_name} {last_name} ({student_number})\n")
+            zip_file.writestr(f"{prefix}_verslag.txt", text)
+
+
+exports = {
+    "surpass": surpass_export,
+    "testvision": testvision_export,
+    "blackboard": blackboard_export,
+}
+
+
+def get_argument_parser():
+    argument_parser = argparse.ArgumentParser(description="""
+        Generate a synthetic Surpass, TestVision or Blackboard export for benchmarks.
+    """)
+    argument_parser.add_argument("export",
+                                 choices=exports.keys(),
+                                 help="The kind of export"
+                                 )
+    argument_parser.add_argument("--output",
+                                 required=True,
+                                 help="Name of the generated file, a .csv for Surpass, a .csv or .xlsx for "
+                                      "TestVision and a .zip for Blackboard",
+                                 metavar="export.csv"
+                                 )
+    argument_parser.add_argument("--students",
+                                 type=int,
+                                 default=100,
+                                 help="Number of students (defaults to 100)"
+                                 )
+    argument_parser.add_argument("--questions",
+                                 type=int,
+                                 default=10,
+                                 help="Number of questions, ignored for Blackboard (defaults to 10)"
+                                 )
+    argument_parser.add_argument("--answer-length",
+                                 type=int,
+                                 help="Average number of words of an answer (defaults to 50, or 1000 for Blackboard)"
+                                 )
+    argument_parser.add_argument("--duplicate-rate",
+                                 type=float,
+                                 default=0.05,
+                                 help="Fraction of answers that are near-duplicates of another answer (defaults "
+                                      "to 0.05)"
+                                 )
+    argument_parser.add_argument("--seed",
+                                 type=int,
+                                 default=1,
+                                 help="Seed of the random generator (defaults to 1)"
+                                 )
+    return argument_parser
+
+
+def generate(export, output, students=100, questions=10, answer_length=None, duplicate_rate=0.05, seed=1):
+    options = dict(students=students, duplicate_rate=duplicate_rate, seed=seed)
+    if answer_length:
+        options["answer_length"] = answer_length
+    if export != "blackboard":
+        options["questions"] = questions
+    exports[export](output, **options)
+
+
+if __name__ == "__main__":
+    arguments = get_argument_parser().parse_args()
+    generate(arguments.export, arguments.output, arguments.students, arguments.questions, arguments.answer_length,
+             arguments.duplicate_rate, arguments.seed)
@@ -0,0 +1,186 @@
+import argparse
+import csv
+import os
+import subprocess
+import tempfile
+from multiprocessing import Pipe, Process
+
+import blackboard
+import plagiarism
+from benchmark.generate import generate
+from similarity import metrics
+
+# The kinds of benchmarks with the kind of export they generate and its extension
+benchmarks = {
+    "surpass": ("surpass", ".csv"),
+    "testvision": ("testvision", ".csv"),
+    "testvision-xlsx": ("testvision", ".xlsx"),
+    "blackboard": ("blackboard", ".zip"),
+}
+FIELDS = ["commit", "benchmark", "students", "questions", "answer_length", "duplicate_rate", "metric", "stage",
+          "seconds", "cpu_seconds", "peak_rss_mb", "peak_worker_rss_mb"]
+
+
+class ReportConnection:
+    """Stands in for the client connection of the detection functions and keeps only their metrics report."""
+
+    def __init__(self):
+        self.report = None
+
+    def send(self, message):
+        status, payload = message
+        if status == "metrics":
+            self.report = payload
+
+
+def report_stages(report):
+    """Return the wall and CPU time and the memory high-water mark of every stage of a metrics report.
+
+    The workers only report their peak memory for the whole run, so every stage gets the same worker peak.
+    """
+    return [
+        {
+            "stage": name,
+            "seconds": round(stage["seconds"], 4),
+            "cpu_seconds": round(stage["cpu_seconds"], 4),
+            "peak_rss_mb": round(stage["peak_rss_mb"], 1),
+            "peak_worker_rss_mb": round(report["peak_worker_rss_mb"], 1),
+        }
+        for name, stage in report["stages"].items()
+    ]
+
+
+def benchmark_exam(input_file, output_file, metric):
+    """Time the stages of plagiarism.detect_plagiarism on a Surpass or TestVision export."""
+    connection = ReportConnection()
+    plagiarism.detect_plagiarism(input_file, output_file, connection, metric=metric)
+    return report_stages(connection.report)
+
+
+def benchmark_blackboard(input_file, output_file, metric):
+    """Time the stages of blackboard.detect_plagiarism on a Blackboard zip, starting with an empty text cache."""
+    connection = ReportConnection()
+    with tempfile.TemporaryDirectory() as cache_directory:
+        blackboard.detect_plagiarism(input_file, output_file, connection, metric=metric,
+                                     cache_directory=cache_directory)
+    return report_stages(connection.report)
+
+
+def run(connection, benchmark, students, questions, answer_length, duplicate_rate, metric, seed):
+    export, extension = benchmarks[benchmark]
+    with tempfile.TemporaryDirectory() as directory:
+        input_file = os.path.join(directory, "export" + extension)
+        output_file = os.path.join(directory, "plagiarism.xlsx")
+        generate(export, input_file, students, questions, answer_length, duplicate_rate, seed)
+        if export == "blackboard":
+            connection.send(benchmark_blackboard(input_file, output_file, metric))
+        else:
+            connection.send(benchmark_exam(input_file, output_file, metric))
+
+
+def run_in_process(*args):
+    """Run a benchmark in a fresh process, so its peak memory use is not influenced by earlier benchmarks.
+
+    :return The stages of the benchmark, or None if it failed
+    """
+    parent_connection, child_connection = Pipe(duplex=False)
+    process = Process(target=run, args=(child_connection, *args))
+    process.start()
+    # Only the child may hold the sending end, so recv fails instead of waiting forever if the child dies
+    child_connection.close()
+    try:
+        stages = parent_connection.recv()
+    except EOFError:
+        stages = None
+    process.join()
+    return stages
+
+
+def current_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def get_argument_parser():
+    argument_parser = argparse.ArgumentParser(description="""
+        Benchmark the plagiarism detection on synthetic exports of increasing size.
+
+        Every combination of benchmark and number of students is generated with
+        the same seed and measured in a process of its own. The wall time, CPU
+        time and peak memory of every stage are printed and appended to a CSV
+        file, so the scaling curves of different commits can be compared.
+    """)
+    argument_parser.add_argument("--benchmarks",
+                                 nargs="+",
+                                 choices=benchmarks.keys(),
+                                 default=["surpass", "testvision", "blackboard"],
+                                 help="The exports to benchmark (defaults to surpass, testvision and blackboard)"
+                                 )
+    argument_parser.add_argument("--students",
+                                 nargs="+",
+                                 type=int,
+                                 default=[50, 100, 200],
+                                 help="The numbers of students (defaults to 50 100 200)"
+                                 )
+    argument_parser.add_argument("--questions",
+                                 type=int,
+                                 default=10,
+                                 help="Number of questions of Surpass and TestVision exports (defaults to 10)"
+                                 )
+    argument_parser.add_argument("--answer-length",
+                                 type=int,
+                                 help="Average number of words of an answer (defaults to 50, or 1000 for Blackboard)"
+                                 )
+    argument_parser.add_argument("--duplicate-rate",
+                                 type=float,
+                                 default=0.05,
+                                 help="Fraction of answers that are near-duplicates of another answer (defaults "
+                                      "to 0.05)"
+                                 )
+    argument_parser.add_argument("--metric",
+                                 choices=metrics.keys(),
+                                 default="difflib",
+                                 help="Similarity measure used to compare answers (defaults to difflib)"
+                                 )
+    argument_parser.add_argument("--seed",
+                                 type=int,
+                                 default=1,
+                                 help="Seed of the random generator (defaults to 1)"
+                                 )
+    argument_parser.add_argument("--output",
+                                 default="benchmark.csv",
+                                 help="CSV file the results are appended to (defaults to benchmark.csv)",
+                                 metavar="benchmark.csv"
+                                 )
+    return argument_parser
+
+
+if __name__ == "__main__":
+    arguments = get_argument_parser().parse_args()
+    commit = current_commit()
+    new_file = not os.path.exists(arguments.output)
+    with open(arguments.output, "a", newline="") as file:
+        writer = csv.DictWriter(file, FIELDS)
+        if new_file:
+            writer.writeheader()
+        for benchmark in arguments.benchmarks:
+            for students in arguments.students:
+                stages = run_in_process(benchmark, students, arguments.questions, arguments.answer_length,
+                                        arguments.duplicate_rate, arguments.metric, arguments.seed)
+                settings = dict(commit=commit, benchmark=benchmark, students=students, questions=arguments.questions,
+                                answer_length=arguments.answer_length, duplicate_rate=arguments.duplicate_rate,
+                                metric=arguments.metric)
+                if stages is None:
+                    # The traceback of the benchmark process is printed by multiprocessing
+                    writer.writerow(dict(settings, stage="failed"))
+                    print(f"{benchmark:>16} {students:>6} students failed", flush=True)
+                    stages = []
+                for stage in stages:
+                    writer.writerow(dict(settings, **stage))
+                    print(f"{benchmark:>16} {students:>6} students {stage['stage']:>18}: {stage['seconds']:8.3f}s "
+                          f"{stage['peak_rss_mb']:8.1f} MB, workers {stage['peak_worker_rss_mb']:8.1f} MB",
+                          flush=True)
+                file.flush()
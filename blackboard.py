@@ -1,55 +1,131 @@
 import argparse
-import difflib
+import converters
 import magic
+import numpy
 import os
 import pandas
 import re
-import shutil
-import subprocess
-import tempfile
 import zipfile
 from ansilogger import AnsiLogger
-from functools import lru_cache, partial
-from multiprocessing import Pipe, Pool
-from plagiarism import conditional_options
+from functools import partial
+from instrumentation import Instrumentation, instrumented, timed
+from matrixwriter import MatrixWriter
+from minhash import MinHash, candidate_pairs
+from multiprocessing import Pipe
+from pairreport import score, select_pairs, write_pairs
+from progress import ProgressReporter
+from similarity import as_text, metrics
+from textcache import DEFAULT_DIRECTORY, TextCache, data_digest
 
 
-def pandoc_reader(filename):
-    with subprocess.Popen(['pandoc',  '--output', '-', '--to',  'markdown', filename], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL) as process:
-        return process.stdout.read()
+def extract_text(data, cache, timings=None, failures=None):
+    """Return the cache key and the text of the content of a file, only running the converter if the cache misses.
 
+    :param timings A dictionary to which the seconds spent detecting the file type and converting it are added
+    :param failures A list to which the messages of converter runs that failed and were retried are appended
+    :raise converters.ConversionError if the file cannot be converted, in which case nothing is cached
+    """
+    timings = dict() if timings is None else timings
+    with timed(timings, 'magic'):
+        reader, mime_type = converters.find_reader(data)
+    key = cache.key(data_digest(data), converters.converter_version(reader))
+    text = cache.get(key)
+    if text is None:
+        with timed(timings, reader.__name__):
+            text = as_text(converters.read(reader, data, mime_type, failures))
+        cache.put(key, text)
+    else:
+        timings['cache hit'] = 0
+    return key, text
+
+
+def convert_file_to_string(filename, cache_directory=DEFAULT_DIRECTORY):
+    with open(filename, 'rb') as file:
+        return extract_text(file.read(), TextCache(cache_directory))[1]
+
+
+class DirectoryExport:
+    """The files of an unzipped Blackboard export."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def names(self):
+        return sorted(os.listdir(self.directory))
+
+    def read(self, name):
+        with open(os.path.join(self.directory, name), 'rb') as file:
+            return file.read()
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
 
-def pdf_reader(filename):
-    with subprocess.Popen(['pdftotext', '-layout', filename, '-'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL) as process:
-        return process.stdout.read()
+    def __exit__(self, *exc_info):
+        self.close()
 
 
-def sqlite_reader(filename):
-    with subprocess.Popen(['sqlite3', filename, '.dump'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL) as process:
-        return process.stdout.read()
+class ZipExport(DirectoryExport):
+    """The members of a Blackboard zip file, which are read straight from the zip file instead of being extracted."""
 
+    def __init__(self, filename):
+        self.zip_file = zipfile.ZipFile(filename)
 
-def text_reader(filename):
-    with open(filename) as file:
-        return file.read()
+    def names(self):
+        return sorted(info.filename for info in self.zip_file.infolist() if not info.is_dir())
 
+    def read(self, name):
+        return self.zip_file.read(name)
 
-@lru_cache(maxsize=256)
-def convert_file_to_string(filename):
-    converters = {
-        '^application/csv$': text_reader,
-        '^application/pdf$': pdf_reader,
-        '^application/vnd.oasis.opendocument.text$': pandoc_reader,
-        '^application/vnd.openxmlformats-officedocument.wordprocessingml.document$': pandoc_reader,
-        '^application/x-sqlite3$': sqlite_reader,
-        '^text/.+$': text_reader
-    }
+    def close(self):
+        self.zip_file.close()
+
+
+def open_export(input_file):
+    """Open a Blackboard export, which is either a zip file or the directory of an unzipped zip file."""
+    if zipfile.is_zipfile(input_file):
+        return ZipExport(input_file)
+    else:
+        return DirectoryExport(input_file)
+
+
+def is_zip_export(input_file):
+    """Return whether input_file is a zip file with a Blackboard export.
+
+    Excel workbooks, like TestVision exports, are zip files too, so they are told apart by their MIME type.
+    """
+    if not zipfile.is_zipfile(input_file):
+        return False
     with magic.Magic(flags=magic.MAGIC_MIME_TYPE) as m:
-        mime_type = m.id_filename(filename)
-        for mime_regex, reader in converters.items():
-            if re.match(mime_regex, mime_type):
-                return reader(filename)
-        raise RuntimeError(f'Cannot convert file {filename} with mime-type {mime_type} to text')
+        return m.id_filename(input_file) != 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+
+# The export opened by open_worker_export in every conversion worker
+worker_export = None
+
+
+def open_worker_export(input_file):
+    global worker_export
+    worker_export = open_export(input_file)
+
+
+def initialize_conversion_worker(input_file, converter_budget, converter_timeout, converter_retries):
+    open_worker_export(input_file)
+    converters.configure(converter_budget, converter_timeout, converter_retries)
+
+
+# The texts of all converted submissions, loaded once in every scoring worker by load_document_store
+document_store = []
+# The hash functions of the MinHash signatures, drawn once per process instead of for every document
+minhash = MinHash()
+
+
+def load_document_store(cache_directory, keys):
+    global document_store
+    cache = TextCache(cache_directory)
+    document_store = [cache.get(key) for key in keys]
 
 
 def shortify_name(filename):
@@ -60,82 +136,237 @@ def shortify_name(filename):
         return filename
 
 
-def compare(directory, client_connection, pair):
-    message = f'comparison between {shortify_name(pair[0])} and {shortify_name(pair[1])}'
-    client_connection.send(('processing',  message))
+def tiles(size, tile_size):
+    """Split the upper triangle of a size x size matrix in blocks of at most tile_size x tile_size."""
+    for row_start in range(0, size, tile_size):
+        for column_start in range(row_start, size, tile_size):
+            yield (row_start, min(row_start + tile_size, size)), (column_start, min(column_start + tile_size, size))
+
+
+def compare_tile(tile, metric='difflib', min_similarity=None):
+    (row_start, row_stop), (column_start, column_stop) = tile
+    rows = document_store[row_start:row_stop]
+    if row_start == column_start:
+        block = metrics[metric].matrix(rows, min_similarity)
+        numpy.fill_diagonal(block, numpy.nan)
+    else:
+        block = metrics[metric].block(rows, document_store[column_start:column_stop], min_similarity)
+    return tile, block
+
+
+def compare_pairs(pairs, metric='difflib', min_similarity=None):
+    similarities = numpy.fromiter(
+        (metrics[metric].ratio(document_store[x], document_store[y], min_similarity) for x, y in pairs),
+        dtype='float32',
+        count=len(pairs)
+    )
+    return pairs, similarities
+
+
+def convert(cache_directory, name):
+    timings = dict()
+    failures = []
     try:
-        similarity = difflib.SequenceMatcher(
-            lambda x: str(x) in ' \t\n',
-            convert_file_to_string(os.path.join(directory, pair[0])),
-            convert_file_to_string(os.path.join(directory, pair[1]))
-        ).ratio()
-        client_connection.send(('processed', message))
-        return pair, similarity
-    except RuntimeError:
-        client_connection.send(('error', message))
-        return pair, None
-
-
-def student_tab(directory, metafiles):
+        key, _ = extract_text(worker_export.read(name), TextCache(cache_directory), timings, failures)
+        return name, key, timings, failures
+    except converters.ConversionError as error:
+        return name, None, timings, failures + [str(error)]
+
+
+def convert_all(input_file, files, cache_directory, client_connection, instrumentation=None, converter_processes=None,
+                converter_timeout=converters.DEFAULT_TIMEOUT, converter_retries=converters.DEFAULT_RETRIES):
+    """Convert every file of an export exactly once, in parallel, into the text cache.
+
+    The workers share a budget of converter_processes external converters, so
+    the number of pandoc, pdftotext and sqlite3 processes stays bounded
+    independently of the number of workers.
+
+    :param input_file The zip file or directory of the export
+    :param instrumentation The Instrumentation that records the time spent per converter, or None
+    :param converter_processes The maximum number of external converters that run at the same time, or None for the
+    number of CPUs
+    :param converter_timeout The number of seconds after which a converter is killed
+    :param converter_retries The number of times a converter that failed or timed out is run again
+    :return The cache keys of the files, in the order of files, with None for files that could not be converted
+    """
+    instrumentation = instrumentation or Instrumentation()
+    keys = dict()
+    progress = ProgressReporter(client_connection, 'conversions', len(files))
+    budget = converters.process_budget(converter_processes)
+    with instrumentation.pool(initialize_conversion_worker,
+                              (input_file, budget, converter_timeout, converter_retries)) as pool:
+        tasks = pool.imap_unordered(partial(instrumented, partial(convert, cache_directory)), files)
+        for (filename, key, timings, failures), _ in instrumentation.results('convert', tasks):
+            instrumentation.add('converters', timings)
+            if key is None:
+                instrumentation.count('conversion retries', len(failures) - 1)
+                instrumentation.count('conversion errors')
+                client_connection.send(('error', f'conversion of {shortify_name(filename)}: {failures[-1]}'))
+            else:
+                instrumentation.count('conversion retries', len(failures))
+            keys[filename] = key
+            progress.advance(errors=int(key is None))
+    return [keys[filename] for filename in files]
+
+
+def split_metafiles(files):
+    """Split the files of a Blackboard export in metafiles with the student names and the actual submissions."""
+    regex = r'^.+_(?:attempt|poging)_\d{4}(?:-\d\d){5}\.txt'
+    metafiles = [file for file in files if re.match(regex, file)]
+    non_metafiles = [file for file in files if not re.match(regex, file)]
+    return metafiles, non_metafiles
+
+
+def minhash_signature(index):
+    return minhash.signature(document_store[index])
+
+
+def student_tab(export, metafiles):
     student_names = dict()
-    for absolute_filename in (os.path.join(directory, file) for file in metafiles):
-        with open(absolute_filename) as file:
-            match = re.match(r'^(?:Name|Naam): (?P<name>.+) \((?P<student_number>\d+)\)$', file.readline().rstrip())
-            if match:
-                student_names[match['student_number']] = match['name']
+    for metafile in metafiles:
+        first_line = as_text(export.read(metafile)).split('\n', 1)[0]
+        match = re.match(r'^(?:Name|Naam): (?P<name>.+) \((?P<student_number>\d+)\)$', first_line.rstrip())
+        if match:
+            student_names[match['student_number']] = match['name']
     return pandas.DataFrame({
         'student_number': student_names.keys(),
         'name': student_names.values()
     }).set_index('student_number')
 
 
-def detect_plagiarism_in_directory(directory, output_file, client_connection):
-    files = os.listdir(directory)
-    files.sort()
-    regex = r'^.+_(?:attempt|poging)_\d{4}(?:-\d\d){5}\.txt'
-    metafiles = [file for file in files if re.match(regex, file)]
-    non_metafiles = [file for file in files if not re.match(regex, file)]
-    df = pandas.DataFrame(index=non_metafiles, columns=non_metafiles, dtype='float32')
-    with Pool() as pool:
-        pairs = ((x, y) for x in non_metafiles for y in non_metafiles if x < y)
-        for (x, y), similarity in pool.imap_unordered(partial(compare, directory, client_connection), pairs):
-            df.loc[x, y] = similarity
-            df.loc[y, x] = similarity
-    students = student_tab(directory, metafiles)
+def write_results(output_file, students, files, converted, scores, output_format='matrix', pairs_output=None,
+                  report_threshold=0.7, top_k=None, instrumentation=None):
+    """Write the similarity matrix and the suspicious pairs of the submissions of an export.
+
+    :param students The students tab with the names of the students
+    :param files The names of the submissions
+    :param converted The positions in files of the submissions that were converted to text
+    :param scores The similarity matrix of the converted submissions
+    """
+    instrumentation = instrumentation or Instrumentation()
+    matrix = numpy.full((len(files), len(files)), numpy.nan, dtype='float32')
+    matrix[numpy.ix_(converted, converted)] = scores
     student_series = students['name']
     multi_index = pandas.MultiIndex.from_tuples(
-        [(student_series[student_number], non_metafile)
-         for non_metafile in non_metafiles
-         for student_number in re.findall(r'^.+_(\d{6})_(?:attempt|poging)_.+$', non_metafile)
+        [(student_series[student_number], file)
+         for file in files
+         for student_number in re.findall(r'^.+_(\d{6})_(?:attempt|poging)_.+$', file)
         ]
     )
-    df.columns = multi_index
-    df.index = multi_index
-    writer = pandas.ExcelWriter(output_file, engine="xlsxwriter")
-    students.to_excel(writer, sheet_name='students')
-    df.to_excel(writer, sheet_name='similarity')
-    rows, columns = df.shape
-    worksheet = writer.sheets['similarity']
-    worksheet.conditional_format(2, 1, rows + 2, columns + 1, conditional_options)
-    writer.close()
-
-
-def detect_plagiarism(input_file, output_file, client_connection):
+    writer = MatrixWriter(output_file)
+    with instrumentation.stage('write'):
+        writer.write_frame('students', students)
+        if output_format != 'pairs':
+            writer.write_matrix('similarity', multi_index, matrix)
+    if output_format != 'matrix' or pairs_output:
+        with instrumentation.stage('pairs'):
+            rows, columns = select_pairs(matrix, report_threshold, top_k)
+            header = ['student', 'file', 'other student', 'other file', 'similarity']
+            instrumentation.count('reported pairs', len(rows))
+
+            def pairs():
+                for row, column in zip(rows, columns):
+                    yield [*multi_index[row], *multi_index[column], score(matrix[row, column])]
+
+            if output_format != 'matrix':
+                writer.write_rows('pairs', header, pairs())
+            if pairs_output:
+                write_pairs(pairs_output, header, pairs(), ['similarity'])
+    with instrumentation.stage('close'):
+        writer.close()
+
+
+def detect_plagiarism_in_export(input_file, output_file, client_connection, metric='difflib', min_similarity=None,
+                                candidates='all', cache_directory=DEFAULT_DIRECTORY, tile_size=32,
+                                output_format='matrix', pairs_output=None, report_threshold=0.7, top_k=None,
+                                converter_processes=None, converter_timeout=converters.DEFAULT_TIMEOUT,
+                                instrumentation=None):
+    """Detect plagiarism in a Blackboard export without extracting it.
+
+    The files are classified by their names and read straight from the zip file
+    by the conversion workers, so the export never has to fit in a temporary directory.
+
+    :param input_file The zip file or directory of the export
+    :param output_file The filename of the resulting Excel file
+    :param client_connection The connection progress messages are sent to
+    :param metric The name of the similarity measure in similarity.metrics
+    :param min_similarity Pairs that provably score below this threshold are left blank
+    :param candidates Either 'all' to compare all pairs or 'lsh' to only compare pairs found with MinHash
+    :param cache_directory The directory of the cache with text extracted from submissions
+    :param tile_size The number of rows and columns of the blocks of pairs sent to the workers
+    :param output_format Either 'matrix', 'pairs' or 'both'
+    :param pairs_output The filename of a CSV, JSON lines or Parquet file with the suspicious pairs, or None
+    :param report_threshold The minimal similarity of a suspicious pair
+    :param top_k The number of best matches of every submission that are reported as suspicious, or None
+    :param converter_processes The maximum number of external converters that run at the same time, or None
+    :param converter_timeout The number of seconds after which a converter is killed
+    :param instrumentation The Instrumentation that records the time spent per stage, or None
+    """
+    if candidates == 'lsh' and metrics[metric].vectorized:
+        raise RuntimeError(f'The {metric} metric scores all pairs at once and cannot be limited to LSH candidates')
+    instrumentation = instrumentation or Instrumentation()
+    with open_export(input_file) as export:
+        metafiles, non_metafiles = split_metafiles(export.names())
+        students = student_tab(export, metafiles)
+    # Every file is converted exactly once before any pair is scored
+    keys = convert_all(input_file, non_metafiles, cache_directory, client_connection, instrumentation,
+                       converter_processes, converter_timeout)
+    converted = numpy.array([i for i, key in enumerate(keys) if key is not None], dtype=int)
+    converted_keys = [keys[i] for i in converted]
+    if metrics[metric].vectorized:
+        with instrumentation.stage('compare'):
+            cache = TextCache(cache_directory)
+            scores = metrics[metric].matrix([cache.get(key) for key in converted_keys], min_similarity)
+            numpy.fill_diagonal(scores, numpy.nan)
+        instrumentation.count('pairs', len(converted) * (len(converted) - 1) // 2)
+    else:
+        scores = numpy.full((len(converted), len(converted)), numpy.nan, dtype='float32')
+        with instrumentation.pool(load_document_store, (cache_directory, converted_keys)) as pool:
+            if candidates == 'lsh':
+                with instrumentation.stage('signatures'):
+                    signatures = pool.map(minhash_signature, range(len(converted)))
+                    pairs = candidate_pairs(signatures)
+                instrumentation.count('pairs', len(pairs))
+                progress = ProgressReporter(client_connection, 'comparisons', len(pairs))
+                chunks = (pairs[i:i + tile_size * tile_size] for i in range(0, len(pairs), tile_size * tile_size))
+                tasks = pool.imap_unordered(
+                    partial(instrumented, partial(compare_pairs, metric=metric, min_similarity=min_similarity)), chunks)
+                for (chunk, similarities), _ in instrumentation.results('compare', tasks):
+                    x, y = numpy.array(chunk).T
+                    scores[x, y] = scores[y, x] = similarities
+                    progress.advance(len(chunk))
+            else:
+                pair_count = len(converted) * (len(converted) - 1) // 2
+                instrumentation.count('pairs', pair_count)
+                progress = ProgressReporter(client_connection, 'comparisons', pair_count)
+                tasks = pool.imap_unordered(
+                    partial(instrumented, partial(compare_tile, metric=metric, min_similarity=min_similarity)),
+                    tiles(len(converted), tile_size))
+                for (((row_start, row_stop), (column_start, column_stop)), block), _ in instrumentation.results(
+                        'compare', tasks):
+                    scores[row_start:row_stop, column_start:column_stop] = block
+                    scores[column_start:column_stop, row_start:row_stop] = block.T
+                    if row_start == column_start:
+                        progress.advance((row_stop - row_start) * (row_stop - row_start - 1) // 2)
+                    else:
+                        progress.advance(block.size)
+    write_results(output_file, students, non_metafiles, converted, scores, output_format, pairs_output,
+                  report_threshold, top_k, instrumentation)
+
+
+def detect_plagiarism(input_file, output_file, client_connection, profile_directory=None, cprofile=False,
+                      **options):
     """Detect plagiarism in either a zip file or an unzipped directory.
 
     :param input_file A string pointing to either a zip file or an unzipped directory
     :param output_file The filename of the resulting Excel file
+    :param profile_directory The directory metrics.json and cProfile output are written to, or None
+    :param cprofile Whether to write cProfile output of the main process and the workers
+    :param options Keyword arguments passed on to detect_plagiarism_in_export
     """
-    if zipfile.is_zipfile(input_file):
-        directory = tempfile.mkdtemp(prefix="plagiarism-")
-        try:
-            with zipfile.ZipFile(input_file) as zip_file:
-                zip_file.extractall(directory)
-            detect_plagiarism_in_directory(directory, output_file, client_connection)
-        finally:
-            shutil.rmtree(directory)
-    else:
-        detect_plagiarism_in_directory(input_file, output_file, client_connection)
+    instrumentation = Instrumentation(client_connection, profile_directory, cprofile)
+    detect_plagiarism_in_export(input_file, output_file, client_connection, instrumentation=instrumentation, **options)
+    instrumentation.finish()
 
 
 def get_argument_parser():
@@ -169,15 +400,102 @@ def get_argument_parser():
                                  dest="use_ansi",
                                  help="Using this option will prevent ansi colors and line movements"
                                 )
+    argument_parser.add_argument("--metric",
+                                 choices=metrics.keys(),
+                                 default="difflib",
+                                 help="Similarity measure used to compare documents (defaults to difflib)"
+                                )
+    argument_parser.add_argument("--min-similarity",
+                                 type=float,
+                                 help="Only compute the exact similarity of pairs that can reach this threshold; "
+                                      "the cells of other pairs are left blank",
+                                 metavar="0.7"
+                                )
+    argument_parser.add_argument("--candidates",
+                                 choices=["all", "lsh"],
+                                 default="all",
+                                 help="Compare all pairs or only the pairs that MinHash locality-sensitive hashing "
+                                      "marks as likely similar; the cells of other pairs are left blank. Only "
+                                      "the difflib metric supports lsh, the others score all pairs at once "
+                                      "(defaults to all)"
+                                )
+    argument_parser.add_argument("--cache-dir",
+                                 default=DEFAULT_DIRECTORY,
+                                 dest="cache_directory",
+                                 help=f"Directory in which text extracted from submissions is cached "
+                                      f"(defaults to {DEFAULT_DIRECTORY})",
+                                 metavar="directory"
+                                )
+    argument_parser.add_argument("--format",
+                                 choices=["matrix", "pairs", "both"],
+                                 default="matrix",
+                                 dest="output_format",
+                                 help="Write a sheet with the full matrix, a sheet with only the suspicious pairs, "
+                                      "or both (defaults to matrix)"
+                                )
+    argument_parser.add_argument("--pairs-output",
+                                 help="Also write the suspicious pairs to a CSV, JSON lines or Parquet file",
+                                 metavar="pairs.csv"
+                                )
+    argument_parser.add_argument("--report-threshold",
+                                 type=float,
+                                 default=0.7,
+                                 help="Report pairs with a similarity of at least this value (defaults to 0.7)",
+                                 metavar="0.7"
+                                )
+    argument_parser.add_argument("--top-k",
+                                 type=int,
+                                 help="Also report the best k matches of every submission",
+                                 metavar="k"
+                                )
+    argument_parser.add_argument("--profile",
+                                 dest="profile_directory",
+                                 help="Write metrics.json with the time and memory use of every stage and converter "
+                                      "to this directory",
+                                 metavar="directory"
+                                )
+    argument_parser.add_argument("--cprofile",
+                                 action="store_true",
+                                 help="Also write cProfile output of the main process and every worker to the "
+                                      "--profile directory"
+                                )
+    argument_parser.add_argument("--converter-processes",
+                                 type=int,
+                                 help="Maximum number of pandoc, pdftotext and sqlite3 processes that run at the "
+                                      "same time (defaults to the number of CPUs)",
+                                 metavar="n"
+                                )
+    argument_parser.add_argument("--converter-timeout",
+                                 type=float,
+                                 default=converters.DEFAULT_TIMEOUT,
+                                 help=f"Number of seconds after which a converter is killed and, once, retried "
+                                      f"(defaults to {converters.DEFAULT_TIMEOUT})",
+                                 metavar="seconds"
+                                )
     return argument_parser
 
 
 if __name__ == "__main__":
     argument_parser = get_argument_parser()
     arguments = argument_parser.parse_args()
+    if arguments.candidates == "lsh" and metrics[arguments.metric].vectorized:
+        argument_parser.error(f"--candidates lsh cannot be combined with --metric {arguments.metric}, which scores "
+                              f"all pairs at once")
     parent_connection, client_connection = Pipe()
     AnsiLogger(parent_connection, arguments.use_ansi).start()
     try:
-        detect_plagiarism(arguments.input, arguments.output, client_connection)
+        detect_plagiarism(arguments.input, arguments.output, client_connection,
+                          metric=arguments.metric,
+                          min_similarity=arguments.min_similarity,
+                          candidates=arguments.candidates,
+                          cache_directory=arguments.cache_directory,
+                          output_format=arguments.output_format,
+                          pairs_output=arguments.pairs_output,
+                          report_threshold=arguments.report_threshold,
+                          top_k=arguments.top_k,
+                          converter_processes=arguments.converter_processes,
+                          converter_timeout=arguments.converter_timeout,
+                          profile_directory=arguments.profile_directory,
+                          cprofile=arguments.cprofile)
     finally:
         client_connection.send(('completed', None))
@@ -0,0 +1,163 @@
+"""Conversion of submissions to text with external tools.
+
+Converters run with a timeout and failed conversions are retried. The number of
+converters that run at the same time is bounded by a budget that is shared by
+all conversion workers and can be sized separately from the worker pool, for
+example to keep memory hungry pandoc processes in check.
+
+pdftotext, pandoc and sqlite3 convert a single document per invocation (pandoc
+concatenates multiple inputs into one document), so documents are not batched.
+"""
+import os
+import re
+import subprocess
+import tempfile
+from contextlib import nullcontext
+from functools import lru_cache
+from multiprocessing import BoundedSemaphore
+from threading import Lock
+
+import magic
+
+DEFAULT_TIMEOUT = 60
+DEFAULT_RETRIES = 1
+
+
+class ConversionError(RuntimeError):
+    pass
+
+
+class ConverterFailure(ConversionError):
+    """A converter that timed out or failed, which may succeed when it is retried."""
+
+
+# The settings of the converters in this process, set with configure in every conversion worker
+budget = None
+timeout = DEFAULT_TIMEOUT
+retries = DEFAULT_RETRIES
+# A single libmagic handle per process, opened by mime_type when it is first needed. Handles are not thread-safe,
+# and the webapp converts submissions in its request threads, so the handle is only used while holding magic_lock.
+magic_handle = None
+magic_lock = Lock()
+
+
+def process_budget(processes=None):
+    """Return a semaphore that bounds the number of converters that run at the same time in all workers."""
+    return BoundedSemaphore(processes or os.cpu_count())
+
+
+def configure(process_budget=None, conversion_timeout=DEFAULT_TIMEOUT, conversion_retries=DEFAULT_RETRIES):
+    """Set the budget, timeout and retries of the converters, usually from the initializer of a pool worker."""
+    global budget, timeout, retries
+    budget = process_budget
+    timeout = conversion_timeout
+    retries = conversion_retries
+
+
+def run_converter(command, data=None):
+    """Run an external converter with data on its standard input and return its standard output.
+
+    :raise ConverterFailure if the converter timed out or exited with an error
+    :raise ConversionError if the converter is not installed
+    """
+    with budget or nullcontext():
+        try:
+            with subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE) as process:
+                try:
+                    output, error = process.communicate(data, timeout=timeout)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+                    process.communicate()
+                    raise ConverterFailure(f'{command[0]} timed out after {timeout} seconds')
+        except OSError as exception:
+            raise ConversionError(f'{command[0]} is unavailable: {exception}')
+    if process.returncode != 0:
+        message = error.decode(errors='replace').strip().splitlines()
+        raise ConverterFailure(f'{command[0]} exited with {process.returncode}' + (f': {message[-1]}' if message else ''))
+    return output
+
+
+pandoc_formats = {
+    'application/vnd.oasis.opendocument.text': 'odt',
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document': 'docx'
+}
+
+
+def pandoc_reader(data, mime_type):
+    return run_converter(['pandoc', '--from', pandoc_formats[mime_type], '--to', 'markdown', '--output', '-'], data)
+
+
+def pdf_reader(data, mime_type):
+    return run_converter(['pdftotext', '-layout', '-', '-'], data)
+
+
+def sqlite_reader(data, mime_type):
+    # sqlite3 needs a seekable file, so this is the only converter for which the data is written to disk
+    with tempfile.NamedTemporaryFile(suffix='.db') as file:
+        file.write(data)
+        file.flush()
+        return run_converter(['sqlite3', file.name, '.dump'])
+
+
+def text_reader(data, mime_type):
+    return data
+
+
+converters = {
+    r'^application/csv$': text_reader,
+    r'^application/pdf$': pdf_reader,
+    r'^application/vnd.oasis.opendocument.text$': pandoc_reader,
+    r'^application/vnd.openxmlformats-officedocument.wordprocessingml.document$': pandoc_reader,
+    r'^application/(x-|vnd\.)sqlite3$': sqlite_reader,
+    r'^text/.+$': text_reader
+}
+
+version_commands = {
+    pandoc_reader: ['pandoc', '--version'],
+    pdf_reader: ['pdftotext', '-v'],
+    sqlite_reader: ['sqlite3', '--version']
+}
+
+
+@lru_cache(maxsize=None)
+def converter_version(reader):
+    if reader not in version_commands:
+        return reader.__name__
+    try:
+        with subprocess.Popen(version_commands[reader], stdout=subprocess.PIPE, stderr=subprocess.STDOUT) as process:
+            return f'{reader.__name__} {process.stdout.readline().decode().strip()}'
+    except OSError:
+        return f'{reader.__name__} unavailable'
+
+
+def mime_type(data):
+    global magic_handle
+    with magic_lock:
+        if magic_handle is None:
+            magic_handle = magic.Magic(flags=magic.MAGIC_MIME_TYPE)
+        return magic_handle.id_buffer(data)
+
+
+def find_reader(data):
+    """Return the reader for the content of a file and its mime-type."""
+    data_type = mime_type(data)
+    for mime_regex, reader in converters.items():
+        if re.match(mime_regex, data_type):
+            return reader, data_type
+    raise ConversionError(f'Cannot convert a file with mime-type {data_type} to text')
+
+
+def read(reader, data, data_type, failures=None):
+    """Convert data with reader, retrying a failed converter up to the configured number of retries.
+
+    :param failures A list to which the messages of the failed attempts that were retried are appended
+    """
+    for attempt in range(retries + 1):
+        try:
+            return reader(data, data_type)
+        except ConverterFailure as failure:
+            if attempt == retries:
+                raise
+            if failures is not None:
+                failures.append(str(failure))
@@ -0,0 +1,134 @@
+import difflib
+import hashlib
+import html
+import os
+import re
+
+from textcache import TextCache
+
+DEFAULT_CONTEXT = 30
+DEFAULT_MIN_WORDS = 8
+WORD = re.compile(r'\S+')
+
+PAGE = """<!DOCTYPE html>
+<html lang="en">
+    <head>
+        <meta charset="UTF-8">
+        <title>{title}</title>
+        <style>
+            table {{ table-layout: fixed; width: 100%; border-collapse: collapse; }}
+            td {{ vertical-align: top; white-space: pre-wrap; font-family: monospace; padding: 0 1em; }}
+            mark {{ background-color: #ffd27f; }}
+            .gap {{ color: #888; }}
+        </style>
+    </head>
+    <body>
+        <p>{summary}</p>
+        <table>
+            <thead><tr><th>{name1}</th><th>{name2}</th></tr></thead>
+            <tbody><tr><td>{side1}</td><td>{side2}</td></tr></tbody>
+        </table>
+    </body>
+</html>
+"""
+GAP = '\n<span class="gap">[…]</span>\n'
+
+
+def matching_passages(words1, words2, min_words=DEFAULT_MIN_WORDS):
+    """Return the difflib matching blocks of two lists of words that are at least min_words long.
+
+    Short answers can match as a whole, so min_words is lowered to the number of words of the shorter one.
+    """
+    min_words = max(1, min(min_words, len(words1), len(words2)))
+    matcher = difflib.SequenceMatcher(None, words1, words2)
+    return [block for block in matcher.get_matching_blocks() if block.size >= min_words]
+
+
+def highlight(text, begin, end, marks):
+    """Escape text[begin:end], wrapping the (start, end, number) marks that lie within it in <mark> elements."""
+    parts = []
+    position = begin
+    for mark_start, mark_end, number in marks:
+        if begin <= mark_start and mark_end <= end:
+            parts.append(html.escape(text[position:mark_start]))
+            parts.append(f'<mark title="passage {number}">{html.escape(text[mark_start:mark_end])}</mark>')
+            position = mark_end
+    parts.append(html.escape(text[position:end]))
+    return ''.join(parts)
+
+
+def render_side(text, spans, passages, context):
+    """Render the passages of one text with context words around them, leaving out the rest.
+
+    :param spans The (start, end) character offsets of the words of text
+    :param passages The first word, number of words and number of every matching passage
+    :param context The number of words shown before and after every passage
+    """
+    passages = sorted(passages)
+    marks = [(spans[first][0], spans[first + size - 1][1], number) for first, size, number in passages]
+    windows = []
+    for first, size, _ in passages:
+        start, stop = max(first - context, 0), min(first + size + context, len(spans))
+        if windows and start <= windows[-1][1]:
+            windows[-1][1] = max(windows[-1][1], stop)
+        else:
+            windows.append([start, stop])
+    parts = []
+    for start, stop in windows:
+        if start > 0:
+            parts.append(GAP)
+        parts.append(highlight(text, spans[start][0], spans[stop - 1][1], marks))
+    if windows and windows[-1][1] < len(spans):
+        parts.append(GAP)
+    return ''.join(parts)
+
+
+def diff_page(text1, text2, name1, name2, context=DEFAULT_CONTEXT, min_words=DEFAULT_MIN_WORDS):
+    """Return an HTML page that shows the passages two texts have in common side by side.
+
+    Only the passages of at least min_words identical words are shown, with
+    context words around them, so long documents stay readable. The texts are
+    matched word by word with difflib.SequenceMatcher, which is much faster
+    than the line-by-line comparison of difflib.HtmlDiff.
+    """
+    spans1 = [match.span() for match in WORD.finditer(text1)]
+    spans2 = [match.span() for match in WORD.finditer(text2)]
+    words1 = [text1[start:end] for start, end in spans1]
+    words2 = [text2[start:end] for start, end in spans2]
+    passages = matching_passages(words1, words2, min_words)
+    matched = sum(passage.size for passage in passages)
+    if passages:
+        summary = f'Matching passages: {len(passages)}, covering {matched} of {len(words1)} and {len(words2)} words.'
+    else:
+        summary = 'No matching passages.'
+    return PAGE.format(
+        title=html.escape(f'{name1} - {name2}'),
+        summary=summary,
+        name1=html.escape(name1),
+        name2=html.escape(name2),
+        side1=render_side(text1, spans1, [(p.a, p.size, i + 1) for i, p in enumerate(passages)], context),
+        side2=render_side(text2, spans2, [(p.b, p.size, i + 1) for i, p in enumerate(passages)], context)
+    )
+
+
+class DiffCache(TextCache):
+    """On-disk store for rendered diff pages, keyed by the identifiers of the compared texts."""
+
+    @staticmethod
+    def key(*identifiers):
+        return hashlib.sha256('\0'.join(map(str, identifiers)).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.html')
+
+    def page(self, identifiers, texts, context=DEFAULT_CONTEXT, min_words=DEFAULT_MIN_WORDS):
+        """Return the path of the diff page of a pair, rendering and storing it if it is not in the cache yet.
+
+        :param identifiers The values that identify the pair, like the question and the two students
+        :param texts A function that returns the two texts and their names, only called if the cache misses
+        """
+        key = self.key(*identifiers, context, min_words)
+        if not os.path.exists(self.path(key)):
+            text1, text2, name1, name2 = texts()
+            self.put(key, diff_page(text1, text2, name1, name2, context, min_words))
+        return self.path(key)
@@ -1,12 +1,10 @@
-import difflib
 import sys
 from blackboard import convert_file_to_string
+from diffview import diff_page
 
-content1 = str(convert_file_to_string(sys.argv[1])).split('\n')
-content2 = str(convert_file_to_string(sys.argv[2])).split('\n')
+content1 = convert_file_to_string(sys.argv[1])
+content2 = convert_file_to_string(sys.argv[2])
 output = sys.argv[3] if len(sys.argv) == 4 else 'diff.html'
 
-diff = difflib.HtmlDiff(wrapcolumn=60)
-
-with open(output, 'w') as file:
-    file.write(diff.make_file(content1, content2))
+with open(output, 'w', encoding='utf-8') as file:
+    file.write(diff_page(content1, content2, sys.argv[1], sys.argv[2]))
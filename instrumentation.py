@@ -0,0 +1,175 @@
+import cProfile
+import json
+import os
+import resource
+import sys
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from multiprocessing import Pool
+from time import perf_counter, process_time, thread_time
+
+
+def peak_rss(who=resource.RUSAGE_SELF):
+    """Return the peak resident set size in MB of this process or of its largest finished child process."""
+    peak = resource.getrusage(who).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+@contextmanager
+def timed(timings, name):
+    """Add the seconds spent in the with block to timings[name]."""
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0) + perf_counter() - start
+
+
+# The profiler of a pool worker, set by initialize_worker when cProfile output is requested
+worker_profiler = None
+worker_profile_file = None
+
+
+def initialize_worker(profile_directory, initializer=None, initargs=()):
+    global worker_profiler, worker_profile_file
+    worker_profiler = cProfile.Profile()
+    worker_profile_file = os.path.join(profile_directory, f'worker-{os.getpid()}.prof')
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def instrumented(function, argument):
+    """Call function in a pool worker and return its result, the seconds it took and the peak memory of the worker.
+
+    Pools are terminated instead of closed, so a profiled worker writes its
+    profile after every task instead of when it exits.
+    """
+    start = perf_counter()
+    if worker_profiler is None:
+        result = function(argument)
+    else:
+        worker_profiler.enable()
+        try:
+            result = function(argument)
+        finally:
+            worker_profiler.disable()
+            worker_profiler.dump_stats(worker_profile_file)
+    return result, perf_counter() - start, peak_rss()
+
+
+class Instrumentation:
+    """Records where the time and memory of a run go.
+
+    It keeps the wall and CPU time and the memory high-water mark of stages, the
+    time spent on individual items like questions or converters, and counters
+    like the number of compared pairs. When the run is finished they are sent as
+    a ('metrics', report) message over the client connection and, if a profile
+    directory is given, written to metrics.json in that directory. With cprofile
+    the main process and every pool worker also write cProfile output there.
+
+    :param client_connection The connection the metrics are sent to, or None
+    :param profile_directory The directory of metrics.json and the cProfile output, or None
+    :param cprofile Whether to write cProfile output of the main process and the workers
+    """
+
+    def __init__(self, client_connection=None, profile_directory=None, cprofile=False):
+        self.client_connection = client_connection
+        self.profile_directory = profile_directory
+        self.cprofile = cprofile and profile_directory is not None
+        self.start = perf_counter()
+        self.stages = dict()
+        self.timings = defaultdict(dict)
+        self.counters = Counter()
+        self.worker_seconds = 0
+        self.peak_worker_rss = 0
+        if profile_directory:
+            os.makedirs(profile_directory, exist_ok=True)
+        self.profiler = cProfile.Profile() if self.cprofile else None
+        if self.profiler:
+            self.profiler.enable()
+
+    @contextmanager
+    def stage(self, name, cpu_time=process_time):
+        """Time the with block as (part of) a stage. Stages that are entered more than once are added up.
+
+        :param cpu_time The CPU clock, thread_time for stages that run next to the main thread in a thread of their own
+        """
+        start, cpu_start = perf_counter(), cpu_time()
+        try:
+            yield
+        finally:
+            stage = self.stages.setdefault(name, {'seconds': 0, 'cpu_seconds': 0})
+            stage['seconds'] += perf_counter() - start
+            stage['cpu_seconds'] += cpu_time() - cpu_start
+            stage['peak_rss_mb'] = peak_rss()
+
+    def add(self, group, timings):
+        """Add the seconds of a dictionary of timings, like the converters of a file, to a group."""
+        for name, seconds in timings.items():
+            timing = self.timings[group].setdefault(name, {'seconds': 0, 'count': 0})
+            timing['seconds'] += seconds
+            timing['count'] += 1
+
+    def count(self, name, amount=1):
+        self.counters[name] += amount
+
+    def pool(self, initializer=None, initargs=()):
+        """Create a Pool whose workers profile the instrumented tasks if cProfile output was requested."""
+        if self.cprofile:
+            return Pool(initializer=initialize_worker, initargs=(self.profile_directory, initializer, initargs))
+        return Pool(initializer=initializer, initargs=initargs)
+
+    def items(self, stage, items):
+        """Iterate over a lazy sequence, like the jobs of a pool, timing the production of every item as stage.
+
+        Pools take their tasks from the sequence in a thread of their own while the
+        workers run, so the stage overlaps the stages of the main thread and only
+        counts the CPU time of the thread that produces the items.
+        """
+        items = iter(items)
+        while True:
+            with self.stage(stage, thread_time):
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+            yield item
+
+    def results(self, stage, results):
+        """Iterate over the results of instrumented tasks, timing the wait for each of them as stage.
+
+        :return A generator of the results of the tasks and the seconds each task took in its worker
+        """
+        results = iter(results)
+        while True:
+            with self.stage(stage):
+                try:
+                    result, seconds, worker_rss = next(results)
+                except StopIteration:
+                    return
+            self.worker_seconds += seconds
+            self.peak_worker_rss = max(self.peak_worker_rss, worker_rss)
+            yield result, seconds
+
+    def report(self):
+        return {
+            'seconds': perf_counter() - self.start,
+            'stages': self.stages,
+            'timings': self.timings,
+            'counters': dict(self.counters),
+            'worker_seconds': self.worker_seconds,
+            'peak_rss_mb': peak_rss(),
+            'peak_worker_rss_mb': max(self.peak_worker_rss, peak_rss(resource.RUSAGE_CHILDREN)),
+        }
+
+    def finish(self):
+        report = self.report()
+        if self.profiler:
+            self.profiler.disable()
+            self.profiler.dump_stats(os.path.join(self.profile_directory, 'main.prof'))
+        if self.profile_directory:
+            with open(os.path.join(self.profile_directory, 'metrics.json'), 'w') as file:
+                json.dump(report, file, indent=2)
+        if self.client_connection is not None:
+            self.client_connection.send(('metrics', report))
+        return report
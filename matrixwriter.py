@@ -0,0 +1,100 @@
+import os
+
+import numpy
+import pandas
+import xlsxwriter
+
+conditional_options = {
+    'type': '3_color_scale',
+    'min_value': 0.0,
+    'mid_value': 0.5,
+    'max_value': 1.0,
+    'min_type': 'num',
+    'mid_type': 'num',
+    'max_type': 'num',
+    'min_color': '#00FF00',
+    'mid_color': '#FFFF00',
+    'max_color': '#FF0000'
+}
+
+
+class MatrixWriter:
+    """Writes similarity matrices to an Excel file without keeping them in memory.
+
+    The workbook uses the constant_memory mode of xlsxwriter, so every row is
+    flushed to a temporary file as soon as the next row is written. Matrices are
+    written row by row straight from their NumPy arrays and can be freed
+    immediately afterwards. Peak memory is therefore about one matrix instead of
+    all sheets. NaN values are written as blank cells.
+
+    The workbook is written to output_file with a .partial suffix and only renamed
+    to output_file when it is closed, so a file named output_file is complete.
+    """
+
+    def __init__(self, output_file):
+        self.output_file = output_file
+        self.partial_file = output_file + ".partial"
+        self.workbook = xlsxwriter.Workbook(self.partial_file, {'constant_memory': True})
+        self.header_format = self.workbook.add_format({'bold': True, 'border': 1, 'align': 'center'})
+        self.sheet_names = []
+
+    def add_worksheet(self, name):
+        """Add a worksheet with a valid and unique name derived from name."""
+        sheet_name = name.replace("[", "").replace("]", "").replace("*", "").replace(":", "").replace("?", "").replace(
+            "/", "").replace("\\", "")[-31:].lower()
+        if sheet_name in self.sheet_names:
+            sheet_name = sheet_name[:29]
+            i = 0
+            while f"{sheet_name}{i:02d}" in self.sheet_names:
+                i += 1
+            sheet_name = f"{sheet_name}{i:02d}"
+        self.sheet_names.append(sheet_name)
+        return self.workbook.add_worksheet(sheet_name)
+
+    def write_frame(self, name, df):
+        """Write a small DataFrame, like the students tab, including its index."""
+        worksheet = self.add_worksheet(name)
+        worksheet.write_row(0, 0, [df.index.name or ""] + [str(column) for column in df.columns], self.header_format)
+        for row, (label, values) in enumerate(zip(df.index, df.itertuples(index=False)), start=1):
+            worksheet.write(row, 0, label, self.header_format)
+            for column, value in enumerate(values, start=1):
+                if not pandas.isna(value):
+                    worksheet.write(row, column, value)
+        return worksheet
+
+    def write_matrix(self, name, index, matrix):
+        """Write a square similarity matrix with the labels of index as header rows and columns.
+
+        :param name The name of the question, which is turned into a valid sheet name
+        :param index A pandas.Index or pandas.MultiIndex with the labels of the rows and columns
+        :param matrix A square numpy.ndarray
+        :return The name of the added sheet
+        """
+        worksheet = self.add_worksheet(name)
+        levels = index.nlevels
+        labels = [
+            [label.item() if isinstance(label, numpy.generic) else label for label in index.get_level_values(level)]
+            for level in range(levels)
+        ]
+        for level in range(levels):
+            worksheet.write_row(level, 0, [index.names[level] or ""] * levels + labels[level], self.header_format)
+        for row, values in enumerate(matrix):
+            worksheet.write_row(levels + row, 0, [level_labels[row] for level_labels in labels], self.header_format)
+            for column in numpy.flatnonzero(~numpy.isnan(values)):
+                worksheet.write_number(levels + row, levels + column, values[column])
+        worksheet.conditional_format(levels, levels, levels + len(index), levels + len(index), conditional_options)
+        return self.sheet_names[-1]
+
+    def write_rows(self, name, header, rows):
+        """Write a table of rows, like a list of suspicious pairs, with a header row."""
+        worksheet = self.add_worksheet(name)
+        worksheet.write_row(0, 0, header, self.header_format)
+        for row, values in enumerate(rows, start=1):
+            for column, value in enumerate(values):
+                if value is not None:
+                    worksheet.write(row, column, value)
+        return worksheet
+
+    def close(self):
+        self.workbook.close()
+        os.replace(self.partial_file, self.output_file)
@@ -0,0 +1,68 @@
+import zlib
+from collections import defaultdict
+
+import numpy
+
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+
+
+def shingles(text, size=3):
+    """Return the 32 bit hashes of all overlapping word shingles of a text."""
+    words = text.split()
+    if len(words) < size:
+        words = [' '.join(words)] if words else []
+        size = 1
+    return numpy.fromiter(
+        {zlib.crc32(' '.join(words[i:i + size]).encode()) for i in range(len(words) - size + 1)},
+        dtype='uint64'
+    )
+
+
+class MinHash:
+    """MinHash signatures that estimate the Jaccard similarity of the shingle sets of documents.
+
+    The signature of a document contains for each of the num_permutations random
+    hash functions the minimum hash of its shingles. The fraction of equal
+    signature elements of two documents estimates the Jaccard similarity of their
+    shingle sets.
+    """
+
+    def __init__(self, num_permutations=128, shingle_size=3, seed=1):
+        generator = numpy.random.default_rng(seed)
+        self.a = generator.integers(1, MAX_HASH, num_permutations, dtype='uint64')
+        self.b = generator.integers(0, MAX_HASH, num_permutations, dtype='uint64')
+        self.shingle_size = shingle_size
+
+    def signature(self, text, chunk_size=4096):
+        hashes = shingles(text, self.shingle_size)
+        signature = numpy.full(len(self.a), MAX_HASH, dtype='uint64')
+        for start in range(0, len(hashes), chunk_size):
+            chunk = hashes[start:start + chunk_size]
+            permuted = (self.a[:, None] * chunk[None, :] + self.b[:, None]) % MERSENNE_PRIME & MAX_HASH
+            numpy.minimum(signature, permuted.min(axis=1), out=signature)
+        return signature
+
+
+def candidate_pairs(signatures, bands=32):
+    """Use locality-sensitive hashing to find pairs of documents that are likely similar.
+
+    Each signature is split into bands. Documents that have an identical band in
+    common end up in the same bucket and become a candidate pair. With 128
+    permutations and 32 bands of 4 rows, pairs with a Jaccard similarity of 0.5 are
+    found with a probability above 0.98, while pairs below 0.2 rarely are.
+
+    :param signatures A list of MinHash signatures, or None for documents to skip
+    :param bands The number of bands each signature is split in
+    :return A sorted list of index pairs (i, j) with i < j
+    """
+    pairs = set()
+    for band in range(bands):
+        buckets = defaultdict(list)
+        for index, signature in enumerate(signatures):
+            if signature is not None:
+                rows = len(signature) // bands
+                buckets[signature[band * rows:(band + 1) * rows].tobytes()].append(index)
+        for bucket in buckets.values():
+            pairs.update((x, y) for i, x in enumerate(bucket) for y in bucket[i + 1:])
+    return sorted(pairs)
@@ -0,0 +1,143 @@
+import csv
+import json
+import os
+import tempfile
+from itertools import islice
+
+import numpy
+
+
+def select_pairs(scores, threshold=None, top_k=None):
+    """Select the suspicious pairs of a symmetric similarity matrix.
+
+    A pair is selected when its score is at least threshold, or when it is one of
+    the top_k best matches of either student.
+
+    :param scores A square numpy.ndarray where NaN means not compared
+    :param threshold The minimal score of a selected pair, or None
+    :param top_k The number of best matches selected for every student, or None
+    :return Two arrays with the row and column of each pair (row < column), sorted by descending score
+    """
+    size = len(scores)
+    selected = numpy.zeros((size, size), dtype=bool)
+    filled = numpy.where(numpy.isnan(scores), -numpy.inf, scores)
+    numpy.fill_diagonal(filled, -numpy.inf)
+    if threshold is not None:
+        selected |= filled >= threshold
+    if top_k and size > 1:
+        k = min(top_k, size - 1)
+        best = numpy.argpartition(-filled, k - 1, axis=1)[:, :k]
+        rows = numpy.repeat(numpy.arange(size), k)
+        columns = best.ravel()
+        keep = numpy.isfinite(filled[rows, columns])
+        selected[rows[keep], columns[keep]] = True
+    rows, columns = numpy.nonzero(numpy.triu(selected | selected.T, k=1))
+    order = numpy.argsort(-filled[rows, columns], kind='stable')
+    return rows[order], columns[order]
+
+
+def score(value):
+    """Convert a NumPy score to a float, or None for NaN."""
+    return None if numpy.isnan(value) else float(value)
+
+
+def parquet_schema(header, rows, score_columns=()):
+    """Return the Parquet schema of pairs.
+
+    Scores are float64 even when the first rows only have blanks, so later
+    batches always match the schema. The types of the other columns, like the
+    student ids, are taken from rows and default to strings.
+    """
+    import pyarrow
+
+    fields = []
+    for position, name in enumerate(header):
+        if name in score_columns:
+            data_type = pyarrow.float64()
+        else:
+            data_type = pyarrow.array([row[position] for row in rows]).type
+            if pyarrow.types.is_null(data_type):
+                data_type = pyarrow.string()
+        fields.append(pyarrow.field(name, data_type))
+    return pyarrow.schema(fields)
+
+
+def write_pairs(output_file, header, rows, score_columns=()):
+    """Stream pairs to a CSV, JSON lines or Parquet file, depending on the extension of output_file.
+
+    :param output_file The name of a .csv, .json, .jsonl or .parquet file
+    :param header The names of the fields of each row
+    :param rows An iterable of rows, each a sequence of values in the order of header
+    :param score_columns The names of the columns with scores, which may be None for pairs that were not compared
+    """
+    extension = os.path.splitext(output_file)[1].lower()
+    if extension == '.csv':
+        with open(output_file, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(header)
+            writer.writerows(rows)
+    elif extension in ('.json', '.jsonl'):
+        with open(output_file, 'w') as file:
+            for row in rows:
+                file.write(json.dumps(dict(zip(header, row))) + '\n')
+    elif extension == '.parquet':
+        import pyarrow
+        import pyarrow.parquet
+
+        rows = iter(rows)
+        batch = list(islice(rows, 10000))
+        schema = parquet_schema(header, batch, score_columns)
+        with pyarrow.parquet.ParquetWriter(output_file, schema) as writer:
+            while batch:
+                columns = [[row[position] for row in batch] for position in range(len(header))]
+                writer.write_table(pyarrow.Table.from_arrays(columns, schema=schema))
+                batch = list(islice(rows, 10000))
+    else:
+        raise RuntimeError(f'Cannot write pairs to {output_file}, use a .csv, .json, .jsonl or .parquet file')
+
+
+class MatrixStore:
+    """Keeps the similarity matrices of all questions on disk instead of in memory.
+
+    Every matrix is aligned to the index of all students and saved as a
+    memory-mapped .npy file, so the scores of selected pairs can be looked up
+    later without loading whole matrices.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.directory = tempfile.TemporaryDirectory(prefix='plagiarism-')
+        self.names = []
+        self.matrices = []
+
+    def add(self, name, index, matrix):
+        aligned = numpy.lib.format.open_memmap(
+            os.path.join(self.directory.name, f'{len(self.names)}.npy'),
+            mode='w+',
+            dtype='float32',
+            shape=(len(self.index), len(self.index))
+        )
+        aligned[:] = numpy.nan
+        aligned[numpy.ix_(*[self.index.get_indexer(index)] * 2)] = matrix
+        aligned.flush()
+        self.names.append(name)
+        self.matrices.append(aligned)
+
+    def rows(self, rows, columns, batch_size=10000):
+        """Yield the scores of every question for the given pairs, one array of scores per pair."""
+        for start in range(0, len(rows), batch_size):
+            batch = numpy.s_[start:start + batch_size]
+            scores = numpy.column_stack(
+                [matrix[rows[batch], columns[batch]] for matrix in self.matrices]
+            ) if self.matrices else numpy.empty((len(rows[batch]), 0), dtype='float32')
+            yield from scores
+
+    def close(self):
+        self.matrices = []
+        self.directory.cleanup()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -1,8 +1,10 @@
 import argparse
-import difflib
+import os
 from abc import ABCMeta, abstractmethod
+from collections import Counter
+from contextlib import nullcontext
 from functools import partial
-from multiprocessing import Pipe, Pool
+from multiprocessing import Pipe
 
 import magic
 import numpy
@@ -10,21 +12,14 @@ import pandas
 import xlsxwriter
 
 from ansilogger import AnsiLogger
+from instrumentation import Instrumentation, instrumented
+from matrixwriter import MatrixWriter, conditional_options
+from pairreport import MatrixStore, score, select_pairs, write_pairs
+from progress import ProgressReporter
+from scorestore import ScoreStore
+from similarity import metrics
 from testvision_csv_sanitizer import TestVisionCSVSource
 
-conditional_options = {
-    'type': '3_color_scale',
-    'min_value': 0.0,
-    'mid_value': 0.5,
-    'max_value': 1.0,
-    'min_type': 'num',
-    'mid_type': 'num',
-    'max_type': 'num',
-    'min_color': '#00FF00',
-    'mid_color': '#FFFF00',
-    'max_color': '#FF0000'
-}
-
 
 def get_argument_parser():
     argument_parser = argparse.ArgumentParser(description="""
@@ -40,7 +35,8 @@ def get_argument_parser():
     """)
     argument_parser.add_argument("--input",
                                  default="ItemsDeliveredRawReport.csv",
-                                 help="Name of the input CSV file or XLSX (defaults to ItemsDeliveredRawReport.csv",
+                                 help="Name of the input CSV file or XLSX, or a directory written by --save-answers "
+                                      "(defaults to ItemsDeliveredRawReport.csv",
                                  metavar="input_file_name.csv"
                                  )
     argument_parser.add_argument("--output",
@@ -55,17 +51,78 @@ def get_argument_parser():
                                  dest="use_ansi",
                                  help="Using this option will prevent ansi colors and line movements"
                                 )
+    argument_parser.add_argument("--metric",
+                                 choices=metrics.keys(),
+                                 default="difflib",
+                                 help="Similarity measure used to compare answers (defaults to difflib)"
+                                 )
+    argument_parser.add_argument("--min-similarity",
+                                 type=float,
+                                 help="Only compute the exact similarity of pairs that can reach this threshold; "
+                                      "the cells of other pairs are left blank",
+                                 metavar="0.7"
+                                 )
+    argument_parser.add_argument("--aggregates",
+                                 nargs="+",
+                                 choices=["average", "maximum", "weighted"],
+                                 help="Sheets that combine all questions: the average, the maximum and the average "
+                                      "weighted by how diverse the answers to each question are (defaults to "
+                                      "average, not available with --format pairs)"
+                                 )
+    argument_parser.add_argument("--average-formulas",
+                                 action="store_true",
+                                 help="Write the average sheet as AVERAGE formulas over the question sheets instead "
+                                      "of computed values (not available with --format pairs)"
+                                 )
+    argument_parser.add_argument("--format",
+                                 choices=["matrix", "pairs", "both"],
+                                 default="matrix",
+                                 dest="output_format",
+                                 help="Write a sheet with the full matrix of every question, a sheet with only the "
+                                      "suspicious pairs, or both (defaults to matrix)"
+                                 )
+    argument_parser.add_argument("--pairs-output",
+                                 help="Also write the suspicious pairs to a CSV, JSON lines or Parquet file",
+                                 metavar="pairs.csv"
+                                 )
+    argument_parser.add_argument("--report-threshold",
+                                 type=float,
+                                 default=0.7,
+                                 help="Report pairs with an average similarity of at least this value (defaults "
+                                      "to 0.7)",
+                                 metavar="0.7"
+                                 )
+    argument_parser.add_argument("--top-k",
+                                 type=int,
+                                 help="Also report the best k matches of every student",
+                                 metavar="k"
+                                 )
+    argument_parser.add_argument("--scores-dir",
+                                 dest="scores_directory",
+                                 help="Keep the scores of every question in this directory, so a re-run on an "
+                                      "updated export only compares new or changed answers",
+                                 metavar="plagiarism.scores"
+                                 )
+    argument_parser.add_argument("--save-answers",
+                                 dest="answers_directory",
+                                 help="Save the parsed answers as Parquet in this directory, so later runs can use it "
+                                      "as --input without parsing the export again",
+                                 metavar="answers"
+                                 )
+    argument_parser.add_argument("--profile",
+                                 dest="profile_directory",
+                                 help="Write metrics.json with the time and memory use of every stage and question "
+                                      "to this directory",
+                                 metavar="directory"
+                                 )
+    argument_parser.add_argument("--cprofile",
+                                 action="store_true",
+                                 help="Also write cProfile output of the main process and every worker to the "
+                                      "--profile directory"
+                                 )
     return argument_parser
 
 
-def diff_ratio(a, b):
-    return difflib.SequenceMatcher(lambda x: str(x) in ' \t\n', a, b).ratio()
-
-
-def similarity(string_series, string):
-    return string_series.apply(partial(diff_ratio, string), convert_dtype=False)
-
-
 class Source(metaclass=ABCMeta):
     @abstractmethod
     def get_names(self):
@@ -77,6 +134,13 @@ class Source(metaclass=ABCMeta):
 
     @abstractmethod
     def jobs(self):
+        """Yield a (student ids, answers, question name) tuple for every question.
+
+        The ids and answers are numpy arrays, which are much cheaper to send to the
+        workers than pandas objects. Answers are strings, also when the export has
+        numeric answers, so a question scores the same when it is read back from
+        an AnswerTableSource.
+        """
         pass
 
     def average_tab(self, sheet_names):
@@ -98,6 +162,55 @@ class Source(metaclass=ABCMeta):
         df = pandas.DataFrame(data=data, index=index, columns=index, dtype=str)
         return df
 
+    @abstractmethod
+    def answer_index(self):
+        pass
+
+
+class Aggregates:
+    """Combines the similarity matrices of all questions while they stream in.
+
+    Only a few matrices of the size of the whole cohort are kept. Every question
+    matrix is added to them and can be discarded afterwards. Missing answers and
+    blank cells are ignored.
+
+    The weighted average weighs every question by one minus its average
+    similarity. Questions that most students answer alike, like multiple choice
+    questions, therefore count less than questions with diverse answers.
+    """
+
+    def __init__(self, index):
+        size = len(index)
+        self.index = index
+        self.sum = numpy.zeros((size, size), dtype='float32')
+        self.count = numpy.zeros((size, size), dtype='float32')
+        self.maximum = numpy.full((size, size), numpy.nan, dtype='float32')
+        self.weighted_sum = numpy.zeros((size, size), dtype='float32')
+        self.weight_sum = numpy.zeros((size, size), dtype='float32')
+
+    def add(self, index, matrix):
+        block = numpy.ix_(*[self.index.get_indexer(index)] * 2)
+        valid = ~numpy.isnan(matrix)
+        values = numpy.where(valid, matrix, 0)
+        self.sum[block] += values
+        self.count[block] += valid
+        self.maximum[block] = numpy.fmax(self.maximum[block], matrix)
+        off_diagonal = valid & ~numpy.eye(len(matrix), dtype=bool)
+        weight = 1 - values[off_diagonal].mean() if off_diagonal.any() else 1
+        self.weighted_sum[block] += weight * values
+        self.weight_sum[block] += weight * valid
+
+    @staticmethod
+    def divide(numerator, denominator):
+        return numpy.divide(numerator, denominator, out=numpy.full_like(numerator, numpy.nan),
+                            where=denominator > 0)
+
+    def average(self):
+        return self.divide(self.sum, self.count)
+
+    def weighted_average(self):
+        return self.divide(self.weighted_sum, self.weight_sum)
+
 
 class SurpassSource(Source):
     def __init__(self, input_file):
@@ -119,25 +232,37 @@ class SurpassSource(Source):
 
         for column_name in reactions.columns:
             name = names[column_name.replace("Reactie", "Naam")]
-            answers = reactions.loc[:, column_name]
-            yield answers, name
+            yield reactions.index.to_numpy(), reactions[column_name].astype(str).to_numpy(), name
 
     def student_index(self):
         return self.df.index
 
+    def answer_index(self):
+        return self.df.index
+
 
 class TestvisionSource(Source):
+    columns = ['KandidaatWeergavenaam', 'OngeldigePogingen', 'VraagNaam', 'VraagVorm', 'Antwoord', 'KeuzeAntwoord']
 
-    def __init__(self, input_file):
+    def __init__(self, input_file, chunk_size=100000):
+        """Read only the columns that are used. CSV files are parsed chunk_size rows at a time and invalid
+        attempts are dropped per chunk, so the whole export is never in memory at once."""
         with magic.Magic(flags=magic.MAGIC_MIME_TYPE) as m:
             mime_type = m.id_filename(input_file)
             if mime_type == 'application/csv' or mime_type == 'text/plain':
                 self.index_field = 'KandidaatExternId'
-                df = pandas.read_csv(TestVisionCSVSource(input_file), encoding='latin-1', sep=';').set_index(self.index_field).sort_index()
+                with TestVisionCSVSource(input_file) as csv_file:
+                    chunks = pandas.read_csv(csv_file, sep=';', usecols=[self.index_field] + self.columns,
+                                             chunksize=chunk_size)
+                    valid = [chunk[chunk["OngeldigePogingen"] == 0] for chunk in chunks]
+                # An export without rows can yield no chunks at all, which pandas.concat refuses
+                df = pandas.concat(valid) if valid else pandas.DataFrame(columns=[self.index_field] + self.columns)
             elif mime_type == 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet':
                 self.index_field = 'KandidaatId'
-                df = pandas.read_excel(input_file, index_col=self.index_field, sheet_name='Data', engine='openpyxl').sort_index()
-        self.df = df[df["OngeldigePogingen"] == 0]
+                df = pandas.read_excel(input_file, usecols=[self.index_field] + self.columns, sheet_name='Data',
+                                       engine='openpyxl')
+                df = df[df["OngeldigePogingen"] == 0]
+        self.df = df.set_index(self.index_field).sort_index(kind='stable')
 
     def get_names(self):
         return self.df['VraagNaam'].unique()
@@ -146,31 +271,118 @@ class TestvisionSource(Source):
         return self.df[['KandidaatWeergavenaam']].drop_duplicates()
 
     def jobs(self):
-        for name in self.get_names():
-            filtered = self.df[self.df['VraagNaam'] == name]
+        # A single groupby partitions the rows of all questions at once, in the order of get_names
+        for name, filtered in self.df.groupby('VraagNaam', sort=False):
             question_type = filtered['VraagVorm'].iloc[0]
             if question_type == 'MeervoudigInvul':
-                answers = filtered.groupby(self.index_field).apply(lambda x: '\n'.join(str(x['Antwoord'])))
+                # One row per blank, joined into a single answer per student
+                answers = filtered['Antwoord'].fillna("").astype(str).groupby(level=0, sort=False).agg('\n'.join)
             elif question_type in ['Open', 'Invul', 'InvulNumeriek']:
                 answers = filtered['Antwoord']
             else:
                 answers = filtered['KeuzeAntwoord']
-            yield answers.replace(numpy.nan, ""), name
+            answers = answers.replace(numpy.nan, "").astype(str)
+            yield answers.index.to_numpy(), answers.to_numpy(), name
 
     def student_index(self):
         return self.df['KandidaatWeergavenaam'].unique()
 
+    def answer_index(self):
+        return self.df.index.unique()
+
+
+class AnswerTableSource(Source):
+    """Answers that were already parsed from a Surpass or TestVision export.
+
+    The answers are kept as a long table with one row per student and question,
+    and stored as Parquet in a directory together with the students tab. Reading
+    it back is much faster than parsing the original export again. Questions are
+    identified by their position in the export, because Surpass exports can
+    contain several questions with the same name.
+    """
+
+    def __init__(self, answers, students):
+        self.answers = answers
+        self.students = students
+
+    @classmethod
+    def from_source(cls, source):
+        index = source.answer_index()
+        answers = pandas.concat([
+            pandas.DataFrame({
+                "position": index.get_indexer(ids),
+                "student": ids,
+                "question_id": question_id,
+                "question": name,
+                "answer": answers.astype(str),
+            })
+            for question_id, (ids, answers, name) in enumerate(source.jobs())
+        ], ignore_index=True)
+        return cls(answers, source.student_tab())
+
+    @classmethod
+    def read(cls, directory):
+        return cls(pandas.read_parquet(os.path.join(directory, "answers.parquet")),
+                   pandas.read_parquet(os.path.join(directory, "students.parquet")))
+
+    def write(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.students.to_parquet(os.path.join(directory, "students.parquet"))
+        self.answers.to_parquet(os.path.join(directory, "answers.parquet"), index=False)
+
+    def question_key(self):
+        # Answer tables saved before questions had an id can only be told apart by name
+        return "question_id" if "question_id" in self.answers.columns else "question"
+
+    def get_names(self):
+        return self.answers.drop_duplicates(self.question_key())["question"].to_numpy()
+
+    def student_tab(self):
+        return self.students
+
+    def jobs(self):
+        for _, group in self.answers.groupby(self.question_key(), sort=False):
+            yield group["student"].to_numpy(), group["answer"].to_numpy(), group["question"].iloc[0]
+
+    def student_index(self):
+        return self.students.index
+
+    def answer_index(self):
+        students = self.answers.drop_duplicates("position").sort_values("position")["student"]
+        return pandas.Index(students, name=self.students.index.name)
 
-def worker(job, client_connection):
-    answers, name = job
-    client_connection.send(("processing", name))
+
+def is_answer_table(input_file):
+    return os.path.isfile(os.path.join(input_file, "answers.parquet"))
+
+
+def numbered(jobs):
+    """Add to every job the number of earlier jobs with the same name, so questions that share a name stay apart."""
+    occurrences = Counter()
+    for ids, answers, name in jobs:
+        yield ids, answers, name, occurrences[name]
+        occurrences[name] += 1
+
+
+def column_names(names):
+    """Yield the column names of the questions in the suspicious pairs, numbering the ones that share a name."""
+    occurrences = Counter()
+    for name in names:
+        occurrences[name] += 1
+        yield f"{name} ({occurrences[name]})" if occurrences[name] > 1 else name
+
+
+def worker(job, metric="difflib", min_similarity=None, scores_directory=None):
+    ids, answers, name, occurrence = job
     try:
-        df = answers.apply(partial(similarity, answers), convert_dtype=False)
-        client_connection.send(("processed", name))
+        if scores_directory:
+            store = ScoreStore(scores_directory, metric, min_similarity)
+            matrix = store.matrix(name, ids, answers, metrics[metric], min_similarity, occurrence)
+        else:
+            matrix = metrics[metric].matrix(answers, min_similarity)
     except TypeError:
-        df = None
-        client_connection.send(("error", name))
-    return df, name
+        matrix = None
+    return ids, matrix, name
 
 
 def is_testvision_source(input_file):
@@ -185,49 +397,116 @@ def is_testvision_source(input_file):
             return True
 
 
-def source_factory(input_file):
-    if is_testvision_source(input_file):
-        return TestvisionSource(input_file)
+def find_source(input_file):
+    """Return the function that reads input_file into a Source."""
+    if is_answer_table(input_file):
+        return AnswerTableSource.read
+    elif is_testvision_source(input_file):
+        return TestvisionSource
     else:
-        return SurpassSource(input_file)
+        return SurpassSource
 
 
-def detect_plagiarism(input_file, output_file, client_connection):
-    source = source_factory(input_file)
-    writer = pandas.ExcelWriter(output_file, engine="xlsxwriter")
-    source.student_tab().to_excel(writer, sheet_name="students")
+def source_factory(input_file):
+    return find_source(input_file)(input_file)
+
+
+def detect_plagiarism(input_file, output_file, client_connection, metric="difflib", min_similarity=None,
+                      aggregates=("average",), average_formulas=False, output_format="matrix", pairs_output=None,
+                      report_threshold=0.7, top_k=None, scores_directory=None, pool=None, answers_directory=None,
+                      profile_directory=None, cprofile=False):
+    instrumentation = Instrumentation(client_connection, profile_directory, cprofile)
+    with instrumentation.stage("detect type"):
+        read_source = find_source(input_file)
+    with instrumentation.stage("parse"):
+        source = read_source(input_file)
+    if answers_directory:
+        with instrumentation.stage("save answers"):
+            source = AnswerTableSource.from_source(source)
+            source.write(answers_directory)
+    writer = MatrixWriter(output_file)
+    with instrumentation.stage("write"):
+        writer.write_frame("students", source.student_tab())
     sheet_names = []
-
-    with Pool() as pool:
-        for df, name in pool.imap(partial(worker, client_connection=client_connection), source.jobs()):
-            if df is not None:
-                sheet_name = name.replace("[", "").replace("]", "").replace("*", "").replace(":", "").replace("?",
-                                                                                                              "").replace(
-                    "/", "").replace("\\", "")[-31:].lower()
-                if sheet_name in sheet_names:
-                    sheet_name = sheet_name[:29]
-                    i = 0
-                    while f"{sheet_name}{i:02d}" in sheet_names:
-                        i += 1
-                    sheet_name = f"{sheet_name}{i:02d}"
-                sheet_names.append(sheet_name)
-                df.to_excel(writer, sheet_name=sheet_name)
-                rows, columns = df.shape
-                worksheet = writer.sheets[sheet_name]
-                worksheet.conditional_format(1, 1, rows + 1, columns + 1, conditional_options)
+    progress = ProgressReporter(client_connection, "questions", len(source.get_names()))
+    combined = Aggregates(source.answer_index())
+    store = MatrixStore(combined.index)
+    columns = column_names(source.get_names())
+
+    with (instrumentation.pool() if pool is None else nullcontext(pool)) as pool, store:
+        tasks = pool.imap(partial(instrumented, partial(worker, metric=metric, min_similarity=min_similarity,
+                                                        scores_directory=scores_directory)),
+                          numbered(instrumentation.items("jobs", source.jobs())))
+        for (ids, matrix, name), seconds in instrumentation.results("compare", tasks):
+            index = pandas.Index(ids, name=combined.index.name)
+            column = next(columns)
+            instrumentation.add("questions", {column: seconds})
+            instrumentation.count("pairs", len(ids) * (len(ids) - 1) // 2)
+            client_connection.send(("error" if matrix is None else "processed", name))
+            progress.advance(errors=int(matrix is None))
+            if matrix is not None:
+                with instrumentation.stage("write"):
+                    if output_format != "pairs":
+                        sheet_names.append(writer.write_matrix(name, index, matrix))
+                    if output_format != "matrix" or pairs_output:
+                        store.add(column, index, matrix)
+                with instrumentation.stage("aggregate"):
+                    combined.add(index, matrix)
                 client_connection.send(("finished", name))
 
-    averages = source.average_tab(sheet_names)
-    averages.to_excel(writer, sheet_name="average")
-    rows, columns = averages.shape
-    writer.sheets["average"].conditional_format(1, 1, rows + 1, columns + 1, conditional_options)
-    writer.close()
+        if output_format != "matrix" or pairs_output:
+            with instrumentation.stage("pairs"):
+                average = combined.average()
+                rows, columns = select_pairs(average, report_threshold, top_k)
+                header = ["student", "other student"] + store.names + ["average"]
+                instrumentation.count("reported pairs", len(rows))
+
+                def pairs():
+                    labels = [label.item() if isinstance(label, numpy.generic) else label for label in combined.index]
+                    for row, column, scores in zip(rows, columns, store.rows(rows, columns)):
+                        yield [labels[row], labels[column]] + [score(value) for value in scores] + \
+                              [score(average[row, column])]
+
+                if output_format != "matrix":
+                    writer.write_rows("pairs", header, pairs())
+                if pairs_output:
+                    write_pairs(pairs_output, header, pairs(), header[2:])
+
+    if output_format == "pairs":
+        aggregates = ()
+    with instrumentation.stage("aggregate"):
+        if "average" in aggregates:
+            if average_formulas:
+                averages = source.average_tab(sheet_names)
+                rows, columns = averages.shape
+                writer.write_frame("average", averages).conditional_format(1, 1, rows + 1, columns + 1,
+                                                                           conditional_options)
+            else:
+                writer.write_matrix("average", combined.index, combined.average())
+        if "maximum" in aggregates:
+            writer.write_matrix("maximum", combined.index, combined.maximum)
+        if "weighted" in aggregates:
+            writer.write_matrix("weighted average", combined.index, combined.weighted_average())
+    with instrumentation.stage("close"):
+        writer.close()
+    instrumentation.finish()
     client_connection.send(("completed", None))
 
 
 if __name__ == "__main__":
     argument_parser = get_argument_parser()
     arguments = argument_parser.parse_args()
+    if arguments.output_format == "pairs" and (arguments.aggregates or arguments.average_formulas):
+        argument_parser.error("--format pairs only writes the suspicious pairs, so it cannot be combined with "
+                              "--aggregates or --average-formulas")
     parent_connection, client_connection = Pipe()
     AnsiLogger(parent_connection, arguments.use_ansi).start()
-    detect_plagiarism(arguments.input, arguments.output, client_connection)
+    try:
+        detect_plagiarism(arguments.input, arguments.output, client_connection, arguments.metric,
+                          arguments.min_similarity, arguments.aggregates or ["average"], arguments.average_formulas,
+                          arguments.output_format, arguments.pairs_output, arguments.report_threshold, arguments.top_k,
+                          arguments.scores_directory, answers_directory=arguments.answers_directory,
+                          profile_directory=arguments.profile_directory, cprofile=arguments.cprofile)
+    finally:
+        # Stops the logger when the detection fails; after a successful run the logger already stopped
+        client_connection.send(("completed", None))
@@ -0,0 +1,46 @@
+from time import monotonic
+
+
+class ProgressReporter:
+    """Aggregates the progress of many small tasks into rate-limited counter messages.
+
+    Instead of one message per task, a ('progress', counters) message is sent over
+    the client connection at most once every interval seconds, and always when
+    the last task is done. The counters dictionary contains the stage, the number
+    of done tasks, the total number of tasks, the number of errors, the throughput
+    in tasks per second and the estimated number of seconds left.
+    """
+
+    def __init__(self, client_connection, stage, total, interval=0.5):
+        self.client_connection = client_connection
+        self.stage = stage
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.errors = 0
+        self.start = monotonic()
+        self.last_sent = None
+        self.send()
+
+    def advance(self, done=1, errors=0):
+        self.done += done
+        self.errors += errors
+        now = monotonic()
+        if self.done >= self.total or now - self.last_sent >= self.interval:
+            self.send(now)
+
+    def counters(self, now=None):
+        elapsed = (now or monotonic()) - self.start
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        return {
+            'stage': self.stage,
+            'done': self.done,
+            'total': self.total,
+            'errors': self.errors,
+            'rate': rate,
+            'eta': (self.total - self.done) / rate if rate > 0 else None
+        }
+
+    def send(self, now=None):
+        self.last_sent = now or monotonic()
+        self.client_connection.send(('progress', self.counters(self.last_sent)))
@@ -0,0 +1,193 @@
+import asyncio
+import json
+import re
+from queue import Empty, Queue
+from threading import Lock, Thread
+
+# The number of seconds the state of a finished job is kept for subscribers that reconnect
+RETENTION = 300
+KEEP_ALIVE = 20
+STREAM_PATH = re.compile(r'/progress/([0-9a-f]{32})')
+
+
+class ProgressHub(Thread):
+    """Fans the progress messages of jobs out to any number of subscribers.
+
+    The messages of a job are read from its pipe once, by an asyncio event loop
+    that watches all pipes, instead of by a thread per client. The latest message
+    of every question, the latest progress counters and the final messages are
+    kept, so a subscriber that connects late or reconnects first gets the current
+    state of the job and then the messages that follow. The state of a job is
+    forgotten RETENTION seconds after its pipe was closed.
+
+    Subscribers either follow a job from a thread of their own with messages, or
+    connect to the server-sent events server that serve starts on the event loop,
+    where every stream is a coroutine and no thread is needed.
+
+    All state is only touched from the event loop. Other threads talk to it with
+    call_soon_threadsafe, except for the registered jobs, which register and
+    __contains__ use directly and are guarded by a lock.
+    """
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.loop = asyncio.new_event_loop()
+        self.states = dict()
+        self.subscribers = dict()
+        self.connections = dict()
+        self.registered = dict()
+        self.registered_lock = Lock()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def register(self, key, connection):
+        """Start reading the messages of a job, forgetting the state of an earlier job with the same key.
+
+        :param key The key subscribers use to follow the job
+        :param connection The receiving end of the pipe the job sends its messages to
+        """
+        with self.registered_lock:
+            self.registered[key] = connection
+        self.loop.call_soon_threadsafe(self._register, key, connection)
+
+    def _register(self, key, connection):
+        self._close(key)
+        self.states[key] = dict()
+        self.subscribers.setdefault(key, set())
+        self.connections[key] = connection
+        self.loop.add_reader(connection.fileno(), self._receive, key)
+
+    def _close(self, key):
+        connection = self.connections.pop(key, None)
+        if connection is not None:
+            self.loop.remove_reader(connection.fileno())
+            connection.close()
+            self.loop.call_later(RETENTION, self._forget, key, connection)
+
+    def _forget(self, key, connection):
+        with self.registered_lock:
+            if self.registered.get(key) is not connection:
+                # The key was registered again for a new job
+                return
+            del self.registered[key]
+        self.states.pop(key, None)
+        # Subscribers of a job that ended without completing would otherwise wait forever
+        for put in self.subscribers.pop(key, set()):
+            put(("completed", None))
+
+    def _receive(self, key):
+        connection = self.connections[key]
+        try:
+            while not connection.closed and connection.poll():
+                self._publish(key, *connection.recv())
+        except EOFError:
+            self._close(key)
+
+    @staticmethod
+    def state_key(status, payload):
+        if status == "progress":
+            return status, payload["stage"]
+        elif status in ("completed", "failed", "metrics"):
+            return status
+        return "question", payload
+
+    @staticmethod
+    def event(status, payload):
+        """Format a message as a server-sent event, or as a keep-alive comment if status is None."""
+        if status is None:
+            return ": keep-alive\n\n"
+        elif status == "completed":
+            data = {"status": "completed"}
+        elif status in ("progress", "metrics"):
+            data = {"status": status, **payload}
+        else:
+            data = {"status": status, "name": payload}
+        return f"data: {json.dumps(data)}\n\n"
+
+    def _publish(self, key, status, payload):
+        if status is None:
+            return
+        self.states[key][self.state_key(status, payload)] = (status, payload)
+        for put in self.subscribers[key]:
+            put((status, payload))
+        if status == "completed":
+            self._close(key)
+
+    def _subscribe(self, key, put):
+        if key not in self.states:
+            # The job was forgotten since the subscriber looked it up
+            put(("completed", None))
+            return
+        for message in self.states[key].values():
+            put(message)
+        self.subscribers[key].add(put)
+
+    def _unsubscribe(self, key, put):
+        self.subscribers.get(key, set()).discard(put)
+
+    def __contains__(self, key):
+        return key in self.registered
+
+    def messages(self, key, timeout=KEEP_ALIVE):
+        """Yield the current state of a job and then its new messages until it has completed.
+
+        The calling thread blocks on a queue until the job has completed, so with the
+        WSGI server of Flask every stream served this way holds one request thread.
+        (None, None) is yielded when no message arrived within timeout seconds, so
+        the caller can keep the connection alive.
+        """
+        queue = Queue()
+        self.loop.call_soon_threadsafe(self._subscribe, key, queue.put_nowait)
+        try:
+            while True:
+                try:
+                    status, payload = queue.get(timeout=timeout)
+                except Empty:
+                    status, payload = None, None
+                yield status, payload
+                if status == "completed":
+                    break
+        finally:
+            self.loop.call_soon_threadsafe(self._unsubscribe, key, queue.put_nowait)
+
+    def serve(self, host, port):
+        """Serve /progress/<key> as server-sent events on host and port from the event loop of the hub.
+
+        The server only speaks as much HTTP as an EventSource needs. It allows
+        every origin, so the pages of the webapp can connect to it on another port.
+        """
+        server = asyncio.run_coroutine_threadsafe(asyncio.start_server(self._stream, host, port), self.loop)
+        return server.result()
+
+    async def _stream(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            while (await reader.readline()).strip():
+                pass
+            match = STREAM_PATH.fullmatch(request_line[1]) if len(request_line) == 3 else None
+            if request_line[:1] != ['GET'] or match is None or match[1] not in self:
+                writer.write(b"HTTP/1.1 404 Not Found\r\ncontent-length: 0\r\nconnection: close\r\n\r\n")
+                await writer.drain()
+                return
+            writer.write(b"HTTP/1.1 200 OK\r\ncontent-type: text/event-stream\r\ncache-control: no-cache\r\n"
+                         b"access-control-allow-origin: *\r\nconnection: close\r\n\r\n")
+            queue = asyncio.Queue()
+            self._subscribe(match[1], queue.put_nowait)
+            try:
+                while True:
+                    try:
+                        status, payload = await asyncio.wait_for(queue.get(), KEEP_ALIVE)
+                    except asyncio.TimeoutError:
+                        status, payload = None, None
+                    writer.write(self.event(status, payload).encode())
+                    await writer.drain()
+                    if status == "completed":
+                        break
+            finally:
+                self._unsubscribe(match[1], queue.put_nowait)
+        except (ConnectionError, UnicodeDecodeError):
+            pass
+        finally:
+            writer.close()
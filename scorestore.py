@@ -0,0 +1,84 @@
+import hashlib
+import os
+import tempfile
+import zipfile
+
+import numpy
+
+
+def answer_hashes(answers):
+    return numpy.array([hashlib.sha1(str(answer).encode()).hexdigest() for answer in answers])
+
+
+class ScoreStore:
+    """Persists the similarity matrix of every question so re-runs only score new or changed answers.
+
+    Every question is stored as an .npz file with the ids of the students, the
+    hashes of their answers and the float32 similarity matrix. The files are only
+    reused when they were computed with the same metric and threshold. Questions
+    that share a name are told apart by their occurrence, the number of earlier
+    questions with the same name. A missing or unreadable file is a cache miss.
+    """
+
+    def __init__(self, directory, metric, min_similarity=None):
+        self.directory = directory
+        self.settings = f'{metric} {min_similarity}'
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, name, occurrence=0):
+        suffix = f'-{occurrence}' if occurrence else ''
+        return os.path.join(self.directory, hashlib.sha1(name.encode()).hexdigest() + suffix + '.npz')
+
+    def load(self, name, occurrence=0):
+        try:
+            with numpy.load(self.path(name, occurrence)) as stored:
+                if str(stored['settings']) != self.settings:
+                    return None
+                return stored['ids'], stored['hashes'], stored['matrix']
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            return None
+
+    def save(self, name, ids, hashes, matrix, occurrence=0):
+        # A unique temporary file, so workers that store the same question at the same time cannot mix their writes
+        descriptor, temporary_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(descriptor, 'wb') as file:
+            numpy.savez(file, settings=self.settings, ids=ids, hashes=hashes, matrix=matrix)
+        os.replace(temporary_path, self.path(name, occurrence))
+
+    def matrix(self, name, index, answers, metric, min_similarity=None, occurrence=0):
+        """Compute the similarity matrix of a question, reusing the stored scores of unchanged answers.
+
+        Pairs of students whose answers are both unchanged are copied from the
+        stored matrix. Only the rows and columns of new or changed answers are
+        scored, against all answers, before the merged matrix is stored again.
+
+        :param name The name of the question
+        :param occurrence The number of earlier questions with the same name
+        :param index The student ids of the answers
+        :param answers A sequence of answers, in the order of index
+        :param metric A similarity.Metric
+        :param min_similarity Pairs that provably score below this threshold become NaN
+        :return A numpy.ndarray like metric.matrix(answers, min_similarity)
+        """
+        ids = numpy.array([str(student_id) for student_id in index])
+        hashes = answer_hashes(answers)
+        stored = self.load(name, occurrence)
+        if stored is None:
+            matrix = metric.matrix(answers, min_similarity)
+        else:
+            stored_ids, stored_hashes, stored_matrix = stored
+            stored_positions = {(student_id, answer_hash): position
+                                for position, (student_id, answer_hash) in enumerate(zip(stored_ids, stored_hashes))}
+            positions = numpy.array([stored_positions.get(key, -1) for key in zip(ids, hashes)], dtype=int)
+            unchanged = numpy.flatnonzero(positions >= 0)
+            changed = numpy.flatnonzero(positions < 0)
+            matrix = numpy.empty((len(ids), len(ids)), dtype='float32')
+            matrix[numpy.ix_(unchanged, unchanged)] = stored_matrix[numpy.ix_(positions[unchanged],
+                                                                              positions[unchanged])]
+            if len(changed):
+                answers = numpy.asarray(answers, dtype=object)
+                block = metric.block(answers[changed], answers, min_similarity)
+                matrix[changed, :] = block
+                matrix[:, changed] = block.T
+        self.save(name, ids, hashes, matrix, occurrence)
+        return matrix
@@ -0,0 +1,414 @@
+import argparse
+import json
+import os
+import tempfile
+from contextlib import contextmanager
+from multiprocessing import Pipe, Process
+from threading import Event, Thread
+from time import sleep, time
+
+import numpy
+
+import blackboard
+import plagiarism
+from ansilogger import AnsiLogger
+from progress import ProgressReporter
+from similarity import metrics
+
+DEFAULT_LEASE = 300
+POLL_INTERVAL = 1
+
+
+def write_atomically(path, write):
+    """Write a file through a temporary file in the same directory, so readers never see a partial file."""
+    descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(descriptor, 'wb') as file:
+        write(file)
+    os.replace(temporary_path, path)
+
+
+def write_json(path, value):
+    write_atomically(path, lambda file: file.write(json.dumps(value).encode()))
+
+
+def read_json(path):
+    with open(path) as file:
+        return json.load(file)
+
+
+class ShardQueue:
+    """A work queue of shards in a directory that the coordinator and all workers can reach.
+
+    Every shard is a JSON file that moves from todo to claimed to done. A worker
+    claims a shard by renaming it into claimed, which only one worker can do,
+    and renews its lease by touching the file while it works on it. Shards whose
+    lease has expired, because their worker crashed or lost its connection, are
+    moved back to todo by the coordinator. A requeued shard may be computed twice.
+    Both workers then store the same results, and every result file is written
+    to a temporary file of its own and renamed into place, so neither worker can
+    overwrite a file the other one is still writing.
+
+    Done shards are never published again, so a coordinator that is restarted on
+    the same queue only waits for the shards that were not finished yet.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        for subdirectory in ('todo', 'claimed', 'done', 'results'):
+            os.makedirs(os.path.join(directory, subdirectory), exist_ok=True)
+
+    def path(self, *parts):
+        return os.path.join(self.directory, *parts)
+
+    def names(self, state):
+        return {name[:-len('.json')] for name in os.listdir(self.path(state)) if name.endswith('.json')}
+
+    def publish(self, shards):
+        """Add the shards that are not done, claimed or queued yet to the queue.
+
+        :param shards A dictionary with the name and the JSON payload of every shard
+        """
+        published = self.names('done') | self.names('claimed') | self.names('todo')
+        for name, shard in shards.items():
+            if name not in published:
+                write_json(self.path('todo', f'{name}.json'), shard)
+
+    def claim(self):
+        """Claim a queued shard.
+
+        :return The name and payload of the claimed shard, or None if no shard is queued
+        """
+        for name in sorted(self.names('todo')):
+            claimed = self.path('claimed', f'{name}.json')
+            try:
+                os.rename(self.path('todo', f'{name}.json'), claimed)
+                os.utime(claimed)
+                return name, read_json(claimed)
+            except FileNotFoundError:
+                # Another worker claimed it first
+                continue
+        return None
+
+    def renew(self, name):
+        try:
+            os.utime(self.path('claimed', f'{name}.json'))
+        except FileNotFoundError:
+            pass
+
+    @contextmanager
+    def lease(self, name, lease=DEFAULT_LEASE):
+        """Renew the lease of a claimed shard in the background during the with block."""
+        stopped = Event()
+
+        def renew():
+            while not stopped.wait(lease / 3):
+                self.renew(name)
+
+        thread = Thread(target=renew, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stopped.set()
+            thread.join()
+
+    def complete(self, name, shard):
+        write_json(self.path('done', f'{name}.json'), shard)
+        for state in ('claimed', 'todo'):
+            try:
+                os.remove(self.path(state, f'{name}.json'))
+            except FileNotFoundError:
+                pass
+
+    def requeue_stale(self, lease=DEFAULT_LEASE):
+        """Move the claimed shards whose lease expired back to todo.
+
+        :return The number of requeued shards
+        """
+        requeued = 0
+        for name in self.names('claimed'):
+            claimed = self.path('claimed', f'{name}.json')
+            try:
+                if time() - os.path.getmtime(claimed) > lease:
+                    os.rename(claimed, self.path('todo', f'{name}.json'))
+                    requeued += 1
+            except FileNotFoundError:
+                pass
+        return requeued
+
+
+def is_blackboard_export(input_file):
+    return blackboard.is_zip_export(input_file) or os.path.isdir(input_file) and not plagiarism.is_answer_table(
+        input_file)
+
+
+def prepare_exam(queue, input_file, questions_per_shard):
+    """Save the answers of a Surpass or TestVision export in the queue and split its questions in shards.
+
+    Shards hold the positions of their questions, because questions can share a name.
+    """
+    if not plagiarism.is_answer_table(queue.path('answers')):
+        plagiarism.AnswerTableSource.from_source(plagiarism.source_factory(input_file)).write(queue.path('answers'))
+    count = len(plagiarism.AnswerTableSource.read(queue.path('answers')).get_names())
+    return {
+        f'questions-{start:06d}': {'questions': list(range(start, min(start + questions_per_shard, count)))}
+        for start in range(0, count, questions_per_shard)
+    }
+
+
+def exam_worker(queue, job):
+    """Return the function that scores the questions of a shard into the score store of the queue.
+
+    The jobs are numbered like plagiarism.detect_plagiarism numbers them, so it finds the scores of questions that
+    share a name when the coordinator merges the shards.
+    """
+    jobs = list(plagiarism.numbered(plagiarism.AnswerTableSource.read(queue.path('answers')).jobs()))
+
+    def score_shard(name, shard):
+        for position in shard['questions']:
+            plagiarism.worker(jobs[position], job['metric'], job['min_similarity'], queue.path('scores'))
+
+    return score_shard
+
+
+def blackboard_worker(queue, job):
+    """Return the function that scores the tiles of a shard and stores their blocks in the results of the queue."""
+    blackboard.load_document_store(queue.path('texts'), job['keys'])
+
+    def score_shard(name, shard):
+        blocks = dict()
+        for i, (rows, columns) in enumerate(shard['tiles']):
+            _, blocks[f'block{i}'] = blackboard.compare_tile((tuple(rows), tuple(columns)), job['metric'],
+                                                             job['min_similarity'])
+        write_atomically(queue.path('results', f'{name}.npz'), lambda file: numpy.savez(file, **blocks))
+
+    return score_shard
+
+
+def work(queue_directory):
+    """Claim and score shards until every shard of the job in the queue is done.
+
+    A worker can be started before the coordinator has published the job. It
+    keeps polling while other workers hold the remaining shards, so it picks up
+    the shards that are requeued when one of them crashes. Leases are renewed
+    well within the lease of the job, which the coordinator chose.
+    """
+    queue = ShardQueue(queue_directory)
+    while not os.path.exists(queue.path('job.json')):
+        sleep(POLL_INTERVAL)
+    job = read_json(queue.path('job.json'))
+    score_shard = (blackboard_worker if job['kind'] == 'blackboard' else exam_worker)(queue, job)
+    while len(queue.names('done')) < job['shards']:
+        claimed = queue.claim()
+        if claimed is None:
+            sleep(POLL_INTERVAL)
+            continue
+        name, shard = claimed
+        with queue.lease(name, job['lease']):
+            score_shard(name, shard)
+        queue.complete(name, shard)
+
+
+def start_workers(queue_directory, processes):
+    workers = [Process(target=work, args=(queue_directory,), daemon=True) for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    return workers
+
+
+def merge_tiles(queue, shards, size):
+    """Assemble the similarity matrix of the converted submissions from the blocks of all shards."""
+    scores = numpy.full((size, size), numpy.nan, dtype='float32')
+    for name, shard in shards.items():
+        with numpy.load(queue.path('results', f'{name}.npz')) as blocks:
+            for i, ((row_start, row_stop), (column_start, column_stop)) in enumerate(shard['tiles']):
+                block = blocks[f'block{i}']
+                scores[row_start:row_stop, column_start:column_stop] = block
+                scores[column_start:column_stop, row_start:row_stop] = block.T
+    return scores
+
+
+def coordinate(input_file, output_file, queue_directory, client_connection, metric='difflib', min_similarity=None,
+               shard_size=None, tile_size=32, lease=DEFAULT_LEASE, local_workers=0, **options):
+    """Detect plagiarism by splitting the work in shards that workers on any number of hosts score.
+
+    The questions of a Surpass or TestVision export, or the tiles of pairs of
+    the submissions of a Blackboard export, are published as shards in the
+    queue directory. When every shard is done the results are merged into the
+    same Excel file plagiarism.py or blackboard.py would write. Running it again
+    on the same queue resumes the job without scoring the done shards again.
+
+    :param input_file A Surpass or TestVision export, or a Blackboard zip file or directory
+    :param output_file The filename of the resulting Excel file
+    :param queue_directory The directory of the queue, on a file system all workers can reach
+    :param client_connection The connection progress messages are sent to
+    :param metric The name of the similarity measure in similarity.metrics
+    :param min_similarity Pairs that provably score below this threshold are left blank
+    :param shard_size The number of questions or tiles per shard, defaults to 1 question or 16 tiles
+    :param tile_size The number of rows and columns of the tiles of a Blackboard export
+    :param lease The number of seconds after which the shard of an unresponsive worker is requeued
+    :param local_workers The number of workers the coordinator starts on this host
+    :param options Keyword arguments passed on to plagiarism.detect_plagiarism or blackboard.write_results
+    """
+    queue = ShardQueue(queue_directory)
+    kind = 'blackboard' if is_blackboard_export(input_file) else 'exam'
+    settings = {'input_file': os.path.abspath(input_file), 'kind': kind, 'metric': metric,
+                'min_similarity': min_similarity, 'shard_size': shard_size, 'tile_size': tile_size}
+    if os.path.exists(queue.path('job.json')):
+        job = read_json(queue.path('job.json'))
+        if {key: job[key] for key in settings} != settings:
+            raise RuntimeError(f'The queue in {queue_directory} belongs to another job, use an empty directory')
+    if kind == 'blackboard':
+        with blackboard.open_export(input_file) as export:
+            metafiles, files = blackboard.split_metafiles(export.names())
+            students = blackboard.student_tab(export, metafiles)
+        # Converting again only reads the texts back from the text cache of the queue
+        keys = blackboard.convert_all(input_file, files, queue.path('texts'), client_connection)
+        converted = numpy.array([i for i, key in enumerate(keys) if key is not None], dtype=int)
+        tiles = list(blackboard.tiles(len(converted), tile_size))
+        shards = {
+            f'tiles-{start:06d}': {'tiles': tiles[start:start + (shard_size or 16)]}
+            for start in range(0, len(tiles), shard_size or 16)
+        }
+        extra = {'keys': [keys[i] for i in converted]}
+    else:
+        shards = prepare_exam(queue, input_file, shard_size or 1)
+        extra = dict()
+    write_json(queue.path('job.json'), {**settings, **extra, 'lease': lease, 'shards': len(shards)})
+    queue.publish(shards)
+
+    workers = start_workers(queue_directory, local_workers)
+    progress = ProgressReporter(client_connection, 'shards', len(shards))
+    done = len(queue.names('done'))
+    progress.advance(done)
+    while done < len(shards):
+        sleep(POLL_INTERVAL)
+        requeued = queue.requeue_stale(lease)
+        if requeued:
+            client_connection.send(('error', f'requeued {requeued} shards of unresponsive workers'))
+        newly_done = len(queue.names('done'))
+        if newly_done > done:
+            progress.advance(newly_done - done)
+            done = newly_done
+    for worker in workers:
+        worker.join()
+
+    if kind == 'blackboard':
+        scores = merge_tiles(queue, shards, len(converted))
+        blackboard.write_results(output_file, students, files, converted, scores, **options)
+    else:
+        plagiarism.detect_plagiarism(queue.path('answers'), output_file, client_connection, metric, min_similarity,
+                                     scores_directory=queue.path('scores'), **options)
+
+
+def get_argument_parser():
+    argument_parser = argparse.ArgumentParser(description="""
+        Sharded plagiarism detection on several hosts.
+
+        The coordinator command splits a Surpass or TestVision export by
+        question, or the pairs of submissions of a Blackboard export in tiles,
+        and publishes the shards in a queue directory on a file system that all
+        hosts can reach. The worker command, started on any number of hosts,
+        claims and scores shards until all of them are done, after which the
+        coordinator merges them into one Excel file. Shards of crashed workers
+        are requeued, and restarting the coordinator on the same queue resumes
+        the job without scoring the done shards again.
+    """)
+    argument_parser.add_argument("--queue",
+                                 required=True,
+                                 dest="queue_directory",
+                                 help="Directory of the queue, shared by the coordinator and the workers",
+                                 metavar="directory"
+                                 )
+    argument_parser.add_argument("--no-ansi",
+                                 action="store_const",
+                                 const=False,
+                                 default=True,
+                                 dest="use_ansi",
+                                 help="Using this option will prevent ansi colors and line movements"
+                                 )
+    subparsers = argument_parser.add_subparsers(dest="command", required=True)
+    coordinator_parser = subparsers.add_parser("coordinator", help="Publish the shards of an export and merge them")
+    coordinator_parser.add_argument("--input",
+                                    required=True,
+                                    help="Surpass or TestVision export, or Blackboard zip file or directory",
+                                    metavar="input_file_name.csv"
+                                    )
+    coordinator_parser.add_argument("--output",
+                                    default="plagiarism.xlsx",
+                                    help="Name of the generated Excel file (defaults to plagiarism.xlsx)",
+                                    metavar="plagiarism.xlsx"
+                                    )
+    coordinator_parser.add_argument("--metric",
+                                    choices=metrics.keys(),
+                                    default="difflib",
+                                    help="Similarity measure used to compare answers (defaults to difflib)"
+                                    )
+    coordinator_parser.add_argument("--min-similarity",
+                                    type=float,
+                                    help="Only compute the exact similarity of pairs that can reach this threshold; "
+                                         "the cells of other pairs are left blank",
+                                    metavar="0.7"
+                                    )
+    coordinator_parser.add_argument("--shard-size",
+                                    type=int,
+                                    help="Number of questions, or tiles of 32 by 32 submissions, per shard "
+                                         "(defaults to 1 question or 16 tiles)",
+                                    metavar="n"
+                                    )
+    coordinator_parser.add_argument("--lease",
+                                    type=float,
+                                    default=DEFAULT_LEASE,
+                                    help=f"Number of seconds after which the shard of an unresponsive worker is "
+                                         f"requeued (defaults to {DEFAULT_LEASE})",
+                                    metavar="seconds"
+                                    )
+    coordinator_parser.add_argument("--workers",
+                                    type=int,
+                                    default=0,
+                                    dest="local_workers",
+                                    help="Number of workers to start on this host (defaults to 0)",
+                                    metavar="n"
+                                    )
+    coordinator_parser.add_argument("--format",
+                                    choices=["matrix", "pairs", "both"],
+                                    default="matrix",
+                                    dest="output_format",
+                                    help="Write a sheet per question (or with all submissions), a sheet with only "
+                                         "the suspicious pairs, or both (defaults to matrix)"
+                                    )
+    coordinator_parser.add_argument("--pairs-output",
+                                    help="Also write the suspicious pairs to a CSV, JSON lines or Parquet file",
+                                    metavar="pairs.csv"
+                                    )
+    worker_parser = subparsers.add_parser("worker", help="Score the shards of the queue")
+    worker_parser.add_argument("--processes",
+                               type=int,
+                               default=os.cpu_count(),
+                               help="Number of worker processes to start on this host (defaults to the number of "
+                                    "CPUs)",
+                               metavar="n"
+                               )
+    return argument_parser
+
+
+if __name__ == "__main__":
+    argument_parser = get_argument_parser()
+    arguments = argument_parser.parse_args()
+    if arguments.command == "worker":
+        for worker in start_workers(arguments.queue_directory, arguments.processes):
+            worker.join()
+    else:
+        parent_connection, client_connection = Pipe()
+        AnsiLogger(parent_connection, arguments.use_ansi).start()
+        try:
+            coordinate(arguments.input, arguments.output, arguments.queue_directory, client_connection,
+                       metric=arguments.metric,
+                       min_similarity=arguments.min_similarity,
+                       shard_size=arguments.shard_size,
+                       lease=arguments.lease,
+                       local_workers=arguments.local_workers,
+                       output_format=arguments.output_format,
+                       pairs_output=arguments.pairs_output)
+        finally:
+            client_connection.send(("completed", None))
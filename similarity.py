@@ -0,0 +1,216 @@
+import difflib
+from abc import ABCMeta, abstractmethod
+from collections import Counter, defaultdict
+
+import numpy
+import pandas
+from scipy import sparse
+
+from winnowing import fingerprints
+
+
+def is_junk(character):
+    return str(character) in ' \t\n'
+
+
+def bounded_ratio(matcher, min_similarity=None):
+    """Return matcher.ratio() unless cheap upper bounds prove it is below min_similarity.
+
+    real_quick_ratio() bounds the ratio by the lengths of both sequences and
+    quick_ratio() by their character histograms. Both are much cheaper than the
+    quadratic ratio(), so pairs that cannot reach min_similarity are skipped.
+
+    :param matcher A difflib.SequenceMatcher with both sequences set
+    :param min_similarity The threshold below which the exact ratio is not needed, or None
+    :return The exact ratio, or NaN if the pair was ruled out
+    """
+    if min_similarity is not None and (
+            matcher.real_quick_ratio() < min_similarity or matcher.quick_ratio() < min_similarity):
+        return numpy.nan
+    return matcher.ratio()
+
+
+def diff_ratio(a, b, min_similarity=None):
+    return bounded_ratio(difflib.SequenceMatcher(is_junk, a, b), min_similarity)
+
+
+def factorize(documents):
+    return pandas.factorize(numpy.asarray(documents, dtype=object), sort=True, use_na_sentinel=False)
+
+
+def as_text(document):
+    if isinstance(document, bytes):
+        return document.decode('utf-8', errors='replace')
+    return str(document)
+
+
+def similarity_matrix(answers, min_similarity=None):
+    """Compute the symmetric similarity matrix of a sequence of answers.
+
+    Identical answers are collapsed first, so each unordered pair of unique answers
+    is compared only once and the diagonal is not compared at all. The result is
+    expanded back into a len(answers) x len(answers) float32 matrix.
+
+    SequenceMatcher is not symmetric, so the smaller string of each pair is always
+    passed as the first sequence. This makes the result independent of the order
+    of the answers.
+
+    :param answers A sequence of strings
+    :param min_similarity Pairs that provably score below this threshold become NaN
+    :return A numpy.ndarray where element [i, j] is diff_ratio(answers[i], answers[j])
+    """
+    codes, uniques = factorize(answers)
+    size = len(uniques)
+    unique_matrix = numpy.identity(size, dtype='float32')
+    matcher = difflib.SequenceMatcher(is_junk)
+    for column in range(1, size):
+        # SequenceMatcher caches its analysis of the second sequence
+        matcher.set_seq2(uniques[column])
+        for row in range(column):
+            matcher.set_seq1(uniques[row])
+            unique_matrix[row, column] = unique_matrix[column, row] = bounded_ratio(matcher, min_similarity)
+    return unique_matrix[numpy.ix_(codes, codes)]
+
+
+def similarity_block(rows, columns, min_similarity=None):
+    """Compute the similarity of every row and column as a float32 matrix.
+
+    Like similarity_matrix, the smaller string of each pair is the first sequence.
+    """
+    block = numpy.empty((len(rows), len(columns)), dtype='float32')
+    matcher = difflib.SequenceMatcher(is_junk)
+    for j, column in enumerate(columns):
+        matcher.set_seq2(column)
+        for i, row in enumerate(rows):
+            if row <= column:
+                matcher.set_seq1(row)
+                block[i, j] = bounded_ratio(matcher, min_similarity)
+    for i, row in enumerate(rows):
+        matcher.set_seq2(row)
+        for j, column in enumerate(columns):
+            if row > column:
+                matcher.set_seq1(column)
+                block[i, j] = bounded_ratio(matcher, min_similarity)
+    return block
+
+
+class Metric(metaclass=ABCMeta):
+    """A similarity measure between documents where 0 means completely different and 1 exactly the same.
+
+    Vectorized metrics compute a whole matrix at once, so callers should collect all
+    documents first instead of comparing them pair by pair.
+    """
+    vectorized = False
+
+    @abstractmethod
+    def matrix(self, documents, min_similarity=None):
+        pass
+
+    def ratio(self, a, b, min_similarity=None):
+        return self.matrix([a, b], min_similarity)[0, 1]
+
+    def block(self, rows, columns, min_similarity=None):
+        return self.matrix(list(rows) + list(columns), min_similarity)[:len(rows), len(rows):]
+
+
+class DiffLibMetric(Metric):
+    """The ratio of difflib.SequenceMatcher."""
+
+    def matrix(self, documents, min_similarity=None):
+        return similarity_matrix(documents, min_similarity)
+
+    def block(self, rows, columns, min_similarity=None):
+        return similarity_block(rows, columns, min_similarity)
+
+    def ratio(self, a, b, min_similarity=None):
+        return diff_ratio(min(a, b), max(a, b), min_similarity)
+
+
+class NGramMetric(Metric):
+    """Cosine similarity between the character or word n-gram counts of documents.
+
+    All documents are turned into rows of a sparse count matrix, so the whole
+    similarity matrix is a single sparse matrix product.
+    """
+    vectorized = True
+
+    def __init__(self, analyzer='char', n=3):
+        self.analyzer = analyzer
+        self.n = n
+
+    def ngrams(self, text):
+        tokens = text if self.analyzer == 'char' else text.split()
+        if len(tokens) <= self.n:
+            return [tuple(tokens)] if tokens else []
+        return [tuple(tokens[i:i + self.n]) for i in range(len(tokens) - self.n + 1)]
+
+    def vectorize(self, documents):
+        vocabulary = dict()
+        indices = []
+        data = []
+        indptr = [0]
+        for document in documents:
+            counts = Counter(self.ngrams(as_text(document)))
+            indices.extend(vocabulary.setdefault(ngram, len(vocabulary)) for ngram in counts)
+            data.extend(counts.values())
+            indptr.append(len(indices))
+        vectors = sparse.csr_matrix(
+            (numpy.asarray(data, dtype='float32'), indices, indptr),
+            shape=(len(documents), len(vocabulary))
+        )
+        norms = numpy.sqrt(numpy.asarray(vectors.multiply(vectors).sum(axis=1)).ravel())
+        norms[norms == 0] = 1
+        return sparse.diags(1 / norms) @ vectors
+
+    def matrix(self, documents, min_similarity=None):
+        codes, uniques = factorize(documents)
+        vectors = self.vectorize(uniques)
+        unique_matrix = (vectors @ vectors.T).toarray().astype('float32')
+        numpy.fill_diagonal(unique_matrix, 1)
+        if min_similarity is not None:
+            unique_matrix[unique_matrix < min_similarity] = numpy.nan
+        return unique_matrix[numpy.ix_(codes, codes)]
+
+
+class WinnowingMetric(Metric):
+    """The fraction of shared winnowing fingerprints, as used by MOSS.
+
+    Fingerprints are computed once per document and put in an inverted index from
+    fingerprint to documents. Only documents in the same posting list are counted,
+    so the work is roughly linear in the total document length. The score of two
+    documents is twice their number of shared fingerprints divided by the sum of
+    their number of fingerprints.
+    """
+    vectorized = True
+
+    def __init__(self, k=5, window=4):
+        self.k = k
+        self.window = window
+
+    def matrix(self, documents, min_similarity=None):
+        codes, uniques = factorize(documents)
+        index = defaultdict(list)
+        sizes = numpy.zeros(len(uniques), dtype='float32')
+        for document_id, document in enumerate(uniques):
+            hashes = {value for value, _, _ in fingerprints(as_text(document), self.k, self.window)}
+            sizes[document_id] = len(hashes)
+            for value in hashes:
+                index[value].append(document_id)
+        shared = numpy.zeros((len(uniques), len(uniques)), dtype='float32')
+        for posting_list in index.values():
+            if len(posting_list) > 1:
+                shared[numpy.ix_(posting_list, posting_list)] += 1
+        totals = sizes[:, None] + sizes[None, :]
+        unique_matrix = numpy.divide(2 * shared, totals, out=numpy.zeros_like(shared), where=totals > 0)
+        numpy.fill_diagonal(unique_matrix, 1)
+        if min_similarity is not None:
+            unique_matrix[unique_matrix < min_similarity] = numpy.nan
+        return unique_matrix[numpy.ix_(codes, codes)]
+
+
+metrics = {
+    'difflib': DiffLibMetric(),
+    'char-ngram': NGramMetric('char', 3),
+    'word-ngram': NGramMetric('word', 2),
+    'winnowing': WinnowingMetric(),
+}
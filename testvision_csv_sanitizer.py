@@ -1,6 +1,6 @@
-from io import StringIO
+from io import TextIOBase
 
-class TestVisionCSVSource(StringIO):
+class TestVisionCSVSource(TextIOBase):
     """CSV files exported with TestVision are incorrect. This class sanitizes them.
 
     CSV files exported with the learning analytics tool of TestVision has an extra
@@ -8,10 +8,15 @@ class TestVisionCSVSource(StringIO):
     containing the fields. There pandas (or any csv tool) cannot correctly read
     those files. This class strips out the trailing semicolumn.
 
-    It can be used as follows:
+    The file is sanitized while it is read, a line at a time, so it is never held
+    in memory as a whole.
+
+    The file is decoded as latin-1, so the sanitized source is a text stream. It
+    can be used as follows:
 
     >>> import pandas as pd
-    >>> df = pd.read_csv(TestVisionCSVSource('learning_analytics.csv'), encoding='latin-1', sep=';')
+    >>> with TestVisionCSVSource('learning_analytics.csv') as csv_file:
+    ...     df = pd.read_csv(csv_file, sep=';')
 
     This module can also be called from the command line as:
 
@@ -19,17 +24,57 @@ class TestVisionCSVSource(StringIO):
     """
 
     def __init__(self, input_file):
-        stringbuffer = StringIO()
+        super().__init__()
+        self.file = open(input_file, 'rt', encoding='latin-1')
+        self.lines = self.sanitized_lines()
+        self.pending = ''
+
+    def sanitized_lines(self):
         header_read = False
-        with open(input_file, 'rt', encoding='latin-1') as file:
-            for line in file:
-                if header_read:
-                    line = line.rstrip(';\n') + '\n'
-                stringbuffer.write(line)
-                header_read = True
-        super().__init__(stringbuffer.getvalue())
+        for line in self.file:
+            if header_read:
+                line = line.rstrip(';\n') + '\n'
+            yield line
+            header_read = True
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            text = self.pending + ''.join(self.lines)
+            self.pending = ''
+            return text
+        parts = [self.pending]
+        length = len(self.pending)
+        for line in self.lines:
+            parts.append(line)
+            length += len(line)
+            if length >= size:
+                break
+        text = ''.join(parts)
+        self.pending = text[size:]
+        return text[:size]
+
+    def readline(self, size=-1):
+        while '\n' not in self.pending:
+            line = next(self.lines, None)
+            if line is None:
+                break
+            self.pending += line
+        end = self.pending.find('\n') + 1 or len(self.pending)
+        if size is not None and size >= 0:
+            end = min(end, size)
+        line, self.pending = self.pending[:end], self.pending[end:]
+        return line
+
+    def close(self):
+        self.file.close()
+        super().close()
 
 
 if __name__ == '__main__':
-    from sys import argv
-    print(TestVisionCSVSource(argv[1]).getvalue())
+    from shutil import copyfileobj
+    from sys import argv, stdout
+    with TestVisionCSVSource(argv[1]) as source:
+        copyfileobj(source, stdout)
@@ -0,0 +1,43 @@
+import hashlib
+import os
+import tempfile
+
+DEFAULT_DIRECTORY = os.getenv('PLAGIARISM_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'plagiarism'))
+
+
+def data_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class TextCache:
+    """Content-addressed on-disk store for text extracted from submissions.
+
+    Texts are keyed by a hash of the file content and the version of the converter
+    that extracted them. Renamed or re-exported files therefore hit the cache, while
+    upgrading pandoc or pdftotext invalidates it.
+    """
+
+    def __init__(self, directory=DEFAULT_DIRECTORY):
+        self.directory = directory
+
+    @staticmethod
+    def key(digest, converter_version):
+        return hashlib.sha256(f'{converter_version}\0{digest}'.encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.txt')
+
+    def get(self, key):
+        try:
+            with open(self.path(key), encoding='utf-8', newline='') as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, text):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(descriptor, 'w', encoding='utf-8', newline='') as file:
+            file.write(text)
+        os.replace(temporary_path, path)
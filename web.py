@@ -1,19 +1,43 @@
+import csv
 import hashlib
-import json
 import os
-from multiprocessing import Pipe, Process
-from threading import Thread
-from time import sleep
+import re
+from contextlib import contextmanager
+from functools import partial
+from multiprocessing import Pipe, Pool
+from queue import Full, Queue
+from tempfile import NamedTemporaryFile
+from threading import BoundedSemaphore, Lock, Thread
 
-from flask import Flask, Response, render_template, request, send_from_directory
+import pandas
+from flask import Flask, Response, jsonify, redirect, render_template, request, send_from_directory
 from werkzeug.utils import secure_filename
 
+import blackboard
+import converters
 import plagiarism
+from diffview import DiffCache
+from progresshub import ProgressHub
+from textcache import TextCache
 
 UPLOAD_DIR = os.path.join(".", "static")
+MAX_QUEUED_JOBS = int(os.getenv("MAX_QUEUED_JOBS", 10))
+CONCURRENT_JOBS = int(os.getenv("CONCURRENT_JOBS", 1))
+CHUNK_SIZE = 1 << 20
+DEBUG = os.getenv("DEBUG", "0") == "1"
+# The port of the progress streams served by the event loop of the hub, or None to serve them from Flask
+PROGRESS_PORT = os.getenv("PROGRESS_PORT")
+# The files a job writes next to the upload in its directory
+OUTPUT_FILES = {"plagiarism.xlsx", "plagiarism.xlsx.partial", "pairs.csv", "metrics.json"}
 app = Flask(__name__)
-parent_connections = {}
-child_connections = {}
+hub = ProgressHub()
+job_queue = Queue(maxsize=MAX_QUEUED_JOBS)
+jobs = {}
+jobs_lock = Lock()
+pool = None
+# Every running job holds a slot of the worker pool; Blackboard jobs start their own pools and hold all of them
+pool_slots = BoundedSemaphore(CONCURRENT_JOBS)
+pool_slots_lock = Lock()
 
 
 @app.route("/")
@@ -21,24 +45,68 @@ def index():
     return render_template("index.html")
 
 
+def save_upload(upload):
+    """Stream an uploaded file to a temporary file in the upload directory while hashing it.
+
+    :param upload The werkzeug FileStorage of the upload
+    :return The md5 of the upload and the name of the temporary file
+    """
+    md5 = hashlib.md5()
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    with upload.stream as input_file, NamedTemporaryFile(dir=UPLOAD_DIR, delete=False) as temporary_file:
+        for chunk in iter(partial(input_file.read, CHUNK_SIZE), b""):
+            md5.update(chunk)
+            temporary_file.write(chunk)
+    return md5.hexdigest(), temporary_file.name
+
+
 @app.route("/detect", methods=["POST"])
 def detect():
-    with request.files["input_file"].stream as input_file:
-        source_data = input_file.read()
-    md5 = hashlib.md5(source_data).hexdigest()
+    md5, temporary_file = save_upload(request.files["input_file"])
     directory = os.path.join(UPLOAD_DIR, md5)
+    output_file = os.path.join(directory, "plagiarism.xlsx")
+    if os.path.exists(output_file):
+        os.remove(temporary_file)
+        return redirect(f"/pairs/{md5}")
     os.makedirs(directory, exist_ok=True)
     filename = secure_filename(request.files["input_file"].filename)
     input_file = os.path.join(directory, filename)
-    output_file = os.path.join(directory, "plagiarism.xlsx")
-    with open(input_file, "wb") as source_file:
-        source_file.write(source_data)
-    source = plagiarism.source_factory(input_file)
-    names = source.get_names()
-    parent_connections[md5], child_connections[md5] = Pipe()
-    process = Process(target=plagiarism.detect_plagiarism, args=(input_file, output_file, child_connections[md5]))
-    process.start()
-    return render_template("processing.html", count=len(names), md5=md5, names=names)
+    with jobs_lock:
+        if md5 not in jobs or jobs[md5]["state"] == "failed":
+            try:
+                job_queue.put_nowait(md5)
+            except Full:
+                os.remove(temporary_file)
+                return "Too many plagiarism detections are queued, please try again later", 503
+            os.replace(temporary_file, input_file)
+            receiving_connection, sending_connection = Pipe(duplex=False)
+            hub.register(md5, receiving_connection)
+            jobs[md5] = {"state": "queued", "directory": directory, "input_file": input_file,
+                         "output_file": output_file, "answers_directory": os.path.join(directory, "answers"),
+                         "pairs_file": os.path.join(directory, "pairs.csv"), "connection": sending_connection}
+        else:
+            os.remove(temporary_file)
+    return render_template("processing.html", md5=md5, progress_port=PROGRESS_PORT)
+
+
+@app.route("/status/<md5>")
+def status(md5):
+    """Report the state of a job and, while it is queued, its position in the queue."""
+    if os.path.exists(os.path.join(UPLOAD_DIR, md5, "plagiarism.xlsx")):
+        return jsonify({"state": "completed"})
+    with jobs_lock:
+        if md5 not in jobs:
+            return jsonify({"state": "unknown"}), 404
+        result = {"state": jobs[md5]["state"]}
+        if result["state"] == "queued":
+            with job_queue.mutex:
+                queued = list(job_queue.queue)
+            if md5 in queued:
+                result["position"] = queued.index(md5) + 1
+            else:
+                # A runner took the job from the queue and is about to mark it as running
+                result["state"] = "running"
+    return jsonify(result)
 
 
 @app.route('/static/<path:filename>')
@@ -48,40 +116,158 @@ def download_file(filename):
 
 @app.route("/progress/<md5>")
 def progress(md5):
+    """Stream the progress of a job as server-sent events, holding a request thread until the job has completed.
+
+    With PROGRESS_PORT set the pages connect to the server of the hub instead, which needs no thread per stream.
+    """
     def event_log():
-        try:
-            while True:
-                status, name = parent_connections[md5].recv()
-                if status is None:
-                    yield ": keep-alive\n"
-                elif status == "completed":
-                    data = json.dumps({"status": "completed"})
-                    yield f"data: {data}\n\n"
-                    break
-                else:
-                    data = json.dumps({"status": status, "name": name})
-                    yield f"data: {data}\n\n"
-        except EOFError:
-            pass
-
-        del child_connections[md5]
-        del parent_connections[md5]
-
-    if md5 in parent_connections:
-        response = Response(event_log())
-        response.headers["content-type"] = "text/event-stream"
-        response.headers["cache-control"] = "no-cache"
-        response.headers["connection"] = "keep-alive"
-        return response
-
-
-def keepalive():
+        for status, payload in hub.messages(md5):
+            yield hub.event(status, payload)
+
+    if md5 not in hub:
+        return "Unknown plagiarism detection", 404
+    response = Response(event_log())
+    response.headers["content-type"] = "text/event-stream"
+    response.headers["cache-control"] = "no-cache"
+    response.headers["connection"] = "keep-alive"
+    return response
+
+
+def uploaded_file(directory):
+    """Return the uploaded export in the directory of a job, the only file in it that the detection did not write."""
+    for name in os.listdir(directory):
+        if name not in OUTPUT_FILES and os.path.isfile(os.path.join(directory, name)):
+            return os.path.join(directory, name)
+    raise FileNotFoundError(f"No upload in {directory}")
+
+
+def read_pairs(pairs_file):
+    """Read the header and rows of the suspicious pairs of a job, or None and no rows if it did not write them."""
+    if not os.path.exists(pairs_file):
+        return None, []
+    with open(pairs_file, newline="") as file:
+        reader = csv.reader(file)
+        return next(reader), list(reader)
+
+
+@app.route("/pairs/<md5>")
+def pairs(md5):
+    """List the suspicious pairs of a completed job with links to their diffs."""
+    directory = os.path.join(UPLOAD_DIR, md5)
+    if not re.fullmatch(r"[0-9a-f]{32}", md5) or not os.path.exists(os.path.join(directory, "plagiarism.xlsx")):
+        return "Unknown plagiarism detection", 404
+    header, rows = read_pairs(os.path.join(directory, "pairs.csv"))
+    return render_template("pairs.html", md5=md5, header=header, rows=rows,
+                           blackboard=header is not None and header[1] == "file")
+
+
+def answer_texts(answers_directory, question, student, other):
+    """Return the answers of two students to a question from the answer table of a job, and their names.
+
+    :param question The column of the question in the suspicious pairs, which tells apart questions that share a name
+    """
+    answers_file = os.path.join(answers_directory, "answers.parquet")
+    questions = pandas.read_parquet(answers_file, columns=["question_id", "question"]).drop_duplicates("question_id")
+    question_ids = dict(zip(plagiarism.column_names(questions["question"]), questions["question_id"]))
+    answers = pandas.read_parquet(answers_file, filters=[("question_id", "==", question_ids[question])])
+    answers = dict(zip(answers["student"].astype(str), answers["answer"]))
+    return answers[student], answers[other], f"{student}: {question}", f"{other}: {question}"
+
+
+def submission_texts(input_file, file, other):
+    """Return the texts of two submissions of a Blackboard export from the text cache, and their short names."""
+    cache = TextCache()
+    with blackboard.open_export(input_file) as export:
+        texts = [blackboard.extract_text(export.read(name), cache)[1] for name in (file, other)]
+    return texts[0], texts[1], blackboard.shortify_name(file), blackboard.shortify_name(other)
+
+
+@app.route("/diff/<md5>")
+def diff(md5):
+    """Show the passages that two answers to a question, or two Blackboard submissions, have in common.
+
+    The diff is rendered from the parsed answers or the cached text of the
+    submissions the first time it is requested and stored in the diffs
+    directory of the job, so later requests only send the stored page.
+    """
+    directory = os.path.join(UPLOAD_DIR, md5)
+    if not re.fullmatch(r"[0-9a-f]{32}", md5) or not os.path.isdir(directory):
+        return "Unknown plagiarism detection", 404
+    cache = DiffCache(os.path.join(directory, "diffs"))
+    try:
+        if "question" in request.args:
+            question, student, other = request.args["question"], request.args["student"], request.args["other"]
+            path = cache.page((question, student, other),
+                              partial(answer_texts, os.path.join(directory, "answers"), question, student, other))
+        else:
+            file, other = request.args["file"], request.args["other"]
+            path = cache.page((file, other), partial(submission_texts, uploaded_file(directory), file, other))
+    except (KeyError, OSError, converters.ConversionError):
+        return "Unknown pair", 404
+    return send_from_directory(UPLOAD_DIR, os.path.relpath(path, UPLOAD_DIR), mimetype="text/html")
+
+
+@contextmanager
+def reserved_pool_slots(slots):
+    """Hold slots of the worker pool while the with block runs.
+
+    The slots are taken under a lock, so a job that needs all of them is not starved by jobs that need one.
+    """
+    with pool_slots_lock:
+        for _ in range(slots):
+            pool_slots.acquire()
+    try:
+        yield
+    finally:
+        for _ in range(slots):
+            pool_slots.release()
+
+
+def run_jobs():
+    """Run queued jobs one by one, sharing the worker pool with the other job runners."""
     while True:
-        for md5 in child_connections:
-            child_connections[md5].send((None, None))
-        sleep(20)
+        md5 = job_queue.get()
+        with jobs_lock:
+            job = jobs[md5]
+            job["state"] = "running"
+        try:
+            # The upload is only parsed once; retries read the answers saved by the first attempt
+            if plagiarism.is_answer_table(job["answers_directory"]):
+                with reserved_pool_slots(1):
+                    plagiarism.detect_plagiarism(job["answers_directory"], job["output_file"], job["connection"],
+                                                 pool=pool, pairs_output=job["pairs_file"],
+                                                 profile_directory=job["directory"])
+            elif blackboard.is_zip_export(job["input_file"]):
+                # Blackboard exports use the shared text cache, so the diffs of their pairs can be rendered later
+                with reserved_pool_slots(CONCURRENT_JOBS):
+                    blackboard.detect_plagiarism(job["input_file"], job["output_file"], job["connection"],
+                                                 pairs_output=job["pairs_file"], profile_directory=job["directory"])
+                job["connection"].send(("completed", None))
+            else:
+                with reserved_pool_slots(1):
+                    plagiarism.detect_plagiarism(job["input_file"], job["output_file"], job["connection"],
+                                                 pool=pool, pairs_output=job["pairs_file"],
+                                                 answers_directory=job["answers_directory"],
+                                                 profile_directory=job["directory"])
+            with jobs_lock:
+                job["state"] = "completed"
+        except Exception:
+            with jobs_lock:
+                job["state"] = "failed"
+            job["connection"].send(("failed", "Plagiarism detection failed, please check the uploaded file"))
+            job["connection"].send(("completed", None))
+            app.logger.exception("Plagiarism detection of %s failed", md5)
+        finally:
+            job["connection"].close()
+            job_queue.task_done()
 
 
 if __name__ == "__main__":
-    Thread(target=keepalive).start()
-    app.run(host="0.0.0.0", port=os.getenv("PORT", 8080), debug=True)
+    pool = Pool()
+    hub.start()
+    if PROGRESS_PORT:
+        hub.serve("0.0.0.0", int(PROGRESS_PORT))
+    for _ in range(CONCURRENT_JOBS):
+        Thread(target=run_jobs, daemon=True).start()
+    # The reloader would start a second process with its own pool, hub and runners
+    app.run(host="0.0.0.0", port=os.getenv("PORT", 8080), debug=DEBUG, use_reloader=False)
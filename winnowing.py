@@ -0,0 +1,56 @@
+import re
+import zlib
+from collections import deque
+
+
+def fingerprints(text, k=5, window=4):
+    """Select the fingerprints of a text with the winnowing algorithm of MOSS.
+
+    Whitespace is removed and the text is lowercased before all k-grams are hashed.
+    Of every window of consecutive hashes the rightmost minimal hash is selected.
+    Any match of at least k + window - 1 normalised characters therefore shares at
+    least one fingerprint.
+
+    :param text The string to fingerprint
+    :param k The length of the hashed k-grams
+    :param window The number of consecutive k-gram hashes to select a minimum from
+    :return A list of (hash, start, end) tuples where start and end are positions in the original text
+    """
+    positions = [match.start() for match in re.finditer(r'\S', text)]
+    normalised = ''.join(text[position] for position in positions).lower()
+    if not normalised:
+        return []
+    k = min(k, len(normalised))
+    hashes = [zlib.crc32(normalised[i:i + k].encode()) for i in range(len(normalised) - k + 1)]
+    selected = []
+    minima = deque()
+    for i, value in enumerate(hashes):
+        while minima and hashes[minima[-1]] >= value:
+            minima.pop()
+        minima.append(i)
+        if minima[0] <= i - window:
+            minima.popleft()
+        if i >= window - 1 or i == len(hashes) - 1:
+            if not selected or selected[-1] != minima[0]:
+                selected.append(minima[0])
+    return [(hashes[i], positions[i], positions[i + k - 1] + 1) for i in selected]
+
+
+def matching_passages(a, b, k=5, window=4):
+    """Find the passages of a and b that share fingerprints.
+
+    :return A list of ((start_a, end_a), (start_b, end_b)) tuples, sorted by position in a
+    """
+    first_in_b = dict()
+    for value, start, end in fingerprints(b, k, window):
+        first_in_b.setdefault(value, (start, end))
+    passages = []
+    for value, start, end in fingerprints(a, k, window):
+        if value in first_in_b:
+            start_b, end_b = first_in_b[value]
+            if passages and start <= passages[-1][0][1] and passages[-1][1][0] <= start_b <= passages[-1][1][1]:
+                (previous_start, _), (previous_start_b, _) = passages[-1]
+                passages[-1] = ((previous_start, end), (previous_start_b, max(end_b, passages[-1][1][1])))
+            else:
+                passages.append(((start, end), (start_b, end_b)))
+    return passages